@@ -0,0 +1,245 @@
+"""
+Offline benchmark of the answer pipeline of the chat application.
+
+Drives scripted multi-turn conversations through
+`streamlit/simple_the_acolyte_chat_with_rag.py` with Streamlit's AppTest,
+replacing Snowflake with the local fakes from `fake_snowflake.py`, and reports
+per stage latency percentiles, call counts and prompt sizes. The `answer`
+row is the time from the question to the end of the last answer,
+the `turn` row the time until the script run showing it is finished.
+Work done by the engine after the answer, like updating the running
+summary of the chat, overlaps with the next turn.
+
+Usage:
+    python benchmark/benchmark_pipeline.py --variant sequential --variant default
+"""
+
+import argparse
+import json
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from types import ModuleType
+from unittest import mock
+
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+from fake_snowflake import FakeCortex, LatencyModel
+
+APP_FILE = (
+    Path(__file__).resolve().parent.parent / "streamlit" / "simple_the_acolyte_chat_with_rag.py"
+)
+
+CONVERSATIONS = [
+    [
+        "Who is Sol?",
+        "Which actor was playing Sol?",
+        "How did he die?",
+        "When was he killed?",
+    ],
+    [
+        "Who is Torbin?",
+        "Who played Torbin?",
+        "Who is Yoda?",
+        "Does he appear in The Acolyte?",
+        "How does he appear in the Acolyte?",
+    ],
+    [
+        "Who killed Indara?",
+        "List all characters that were killed in The Acolyte.",
+    ],
+]
+
+# Stages producing the answers shown to the user.
+ANSWER_STAGES = ["generic", "rag", "aggregation"]
+
+# Session state overrides of the sidebar options, by variant name.
+VARIANTS = {
+    "default": {},
+    "sequential": {
+        "run_in_parallel": False,
+        "stream_answer": False,
+        "use_completion_cache": False,
+        "incremental_chat_summary": False,
+    },
+    "no-history": {"use_chat_history": False},
+    "routed": {"answer_pipeline": "Route on RAG answer"},
+    "classified": {"answer_pipeline": "Route with classifier"},
+    "local-index": {"retrieval_backend": "Local index"},
+}
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Compute the nearest-rank percentile of the given values.
+
+    Args:
+        values (list): The values to compute the percentile of.
+        q (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile of the values.
+    """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))]
+
+
+@contextmanager
+def replace_module(name: str, module: ModuleType):
+    """
+    Replace the module with the given name for the duration of the block,
+    leaving all other modules imported in the meantime in place.
+
+    Args:
+        name (str): The name of the module to replace.
+        module (ModuleType): The module to use instead.
+    """
+    original = sys.modules.get(name)
+    sys.modules[name] = module
+    try:
+        yield
+    finally:
+        if original is None:
+            del sys.modules[name]
+        else:
+            sys.modules[name] = original
+
+
+def run_variant(
+    variant: str, options: dict, conversations: list, latency: LatencyModel, timeout: float
+) -> dict:
+    """
+    Run all the conversations through the chat application with a fresh
+    set of fakes and the given sidebar options.
+
+    Args:
+        variant (str): The name of the variant.
+        options (dict): Session state overrides of the sidebar options.
+        conversations (list): Lists of questions, one list per conversation.
+        latency (LatencyModel): The latency of the fake Cortex calls.
+        timeout (float): The maximum number of seconds a turn may take.
+
+    Returns:
+        dict: The statistics of the pipeline stages and turns.
+    """
+    fake = FakeCortex(latency)
+    fake_cortex_module = ModuleType("snowflake.cortex")
+    fake_cortex_module.Complete = fake.Complete
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    # The engine module binds the Snowflake imports when it is loaded,
+    # so load it again with the fakes of this variant.
+    sys.modules.pop("acolyte_engine", None)
+
+    turn_seconds = []
+    answer_seconds = []
+    with replace_module("snowflake.cortex", fake_cortex_module), mock.patch(
+        "snowflake.snowpark.context.get_active_session", lambda: fake
+    ), mock.patch("snowflake.core.Root", fake.Root):
+        for questions in conversations:
+            app = AppTest.from_file(str(APP_FILE), default_timeout=timeout)
+            app.session_state["debug"] = False
+            for key, value in options.items():
+                app.session_state[key] = value
+            app.run()
+            for question in questions:
+                started_at = time.perf_counter()
+                app.chat_input[0].set_value(question).run()
+                turn_seconds.append(time.perf_counter() - started_at)
+                answered_at = max(
+                    fake.stats.last_finished_at.get(stage, 0) for stage in ANSWER_STAGES
+                )
+                if answered_at > started_at:
+                    answer_seconds.append(answered_at - started_at)
+                if app.exception:
+                    raise RuntimeError(f"{variant}: {app.exception[0].message}")
+
+    stages = {
+        stage: {
+            "calls": len(calls),
+            "p50_ms": 1000 * percentile([c[0] for c in calls], 50),
+            "p95_ms": 1000 * percentile([c[0] for c in calls], 95),
+            "mean_prompt_tokens": sum(c[1] for c in calls) / len(calls),
+        }
+        for stage, calls in sorted(fake.stats.calls.items())
+    }
+    for stage, seconds in [("answer", answer_seconds), ("turn", turn_seconds)]:
+        if seconds:
+            stages[stage] = {
+                "calls": len(seconds),
+                "p50_ms": 1000 * percentile(seconds, 50),
+                "p95_ms": 1000 * percentile(seconds, 95),
+                "mean_prompt_tokens": 0,
+            }
+    return stages
+
+
+def print_report(variant: str, stages: dict):
+    print(f"\n== {variant}")
+    print(f"{'stage':<14}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'prompt tok':>12}")
+    for stage, s in stages.items():
+        print(
+            f"{stage:<14}{s['calls']:>7}{s['p50_ms']:>10.0f}{s['p95_ms']:>10.0f}"
+            f"{s['mean_prompt_tokens']:>12.0f}"
+        )
+
+
+def parse_option(option: str) -> tuple:
+    key, value = option.split("=", 1)
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--variant",
+        action="append",
+        choices=VARIANTS,
+        help="Predefined set of sidebar options to benchmark, can be repeated.",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override a sidebar option in every variant, e.g. num_retrieved_chunks=20.",
+    )
+    parser.add_argument("--conversations", type=Path, help="JSON file with lists of questions.")
+    parser.add_argument("--round-trip", type=float, default=0.3, help="Seconds per completion.")
+    parser.add_argument("--prompt-tps", type=float, default=20000, help="Prompt tokens/second.")
+    parser.add_argument("--answer-tps", type=float, default=60, help="Answer tokens/second.")
+    parser.add_argument("--answer-tokens", type=int, default=80, help="Tokens per answer.")
+    parser.add_argument("--search", type=float, default=0.4, help="Seconds per search.")
+    parser.add_argument("--timeout", type=float, default=120, help="Max seconds per turn.")
+    parser.add_argument("--json", type=Path, help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    latency = LatencyModel(
+        round_trip_seconds=args.round_trip,
+        prompt_tokens_per_second=args.prompt_tps,
+        answer_tokens_per_second=args.answer_tps,
+        answer_tokens=args.answer_tokens,
+        search_seconds=args.search,
+    )
+    conversations = (
+        json.loads(args.conversations.read_text()) if args.conversations else CONVERSATIONS
+    )
+    overrides = dict(parse_option(o) for o in args.set)
+
+    report = {}
+    for variant in args.variant or ["default"]:
+        options = {**VARIANTS[variant], **overrides}
+        report[variant] = run_variant(variant, options, conversations, latency, args.timeout)
+        print_report(variant, report[variant])
+
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+import csv
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Iterator, List, Union
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+SEARCH_COLUMN = "LISTING_TEXT"
+TARGET_LAG = "1 hour"
+
+STAGE_MARKERS = [
+    ("aggregation", "Merge both answers into one"),
+    ("rag", "with RAG capabilities"),
+    ("summary_fold", "generate a new summary that covers"),
+    ("summary", "a query that extend the question"),
+    ("router", "You are routing questions"),
+]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in the given text,
+    the same way the chat application does.
+
+    Args:
+        text (str): The text to estimate the number of tokens of.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return -(-len(text) // 4)
+
+
+def classify_prompt(prompt: str) -> str:
+    """
+    Find the pipeline stage a prompt was created by.
+
+    Args:
+        prompt (str): The prompt sent to the model.
+
+    Returns:
+        str: The name of the pipeline stage.
+    """
+    for stage, marker in STAGE_MARKERS:
+        if marker in prompt:
+            return stage
+    return "generic"
+
+
+class StageStats:
+    """
+    Thread safe recorder of the calls made to the fake Snowflake services,
+    with their pipeline stage, wall time and prompt size.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(list)
+        self.last_finished_at = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, prompt_tokens: int = 0):
+        with self._lock:
+            self.calls[stage].append((seconds, prompt_tokens))
+            self.last_finished_at[stage] = time.perf_counter()
+
+
+class LatencyModel:
+    """
+    Latency of the fake Cortex calls. A completion takes a fixed round trip,
+    plus the time to read the prompt and to generate the answer at the given
+    token throughputs. A search takes a fixed round trip.
+    """
+
+    def __init__(
+        self,
+        round_trip_seconds: float = 0.3,
+        prompt_tokens_per_second: float = 20000,
+        answer_tokens_per_second: float = 60,
+        answer_tokens: int = 80,
+        search_seconds: float = 0.4,
+    ):
+        self.round_trip_seconds = round_trip_seconds
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.answer_tokens_per_second = answer_tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.search_seconds = search_seconds
+
+    def time_to_first_token(self, prompt: str) -> float:
+        return self.round_trip_seconds + estimate_tokens(prompt) / self.prompt_tokens_per_second
+
+    def seconds_per_answer_token(self) -> float:
+        return 1 / self.answer_tokens_per_second
+
+
+def load_documents() -> dict:
+    """
+    Load the episodes and cast datasets, and build the search column
+    and the attribute columns of every row the same way as the SQL
+    scripts in `data/` do.
+
+    Returns:
+        dict: Lists of rows by cortex search service name.
+    """
+    with open(DATA_DIR / "episodes" / "season_1-all_episodes.tsv", encoding="utf-8") as f:
+        episodes = [
+            {
+                SEARCH_COLUMN: f"The Acolyte, eposode {r['no']}, directed by {r['directed_by']}, "
+                f"written by {r['written_by']}, released on {r['original_release_date']}"
+                f"\n\n\nPlot: \n{r['plot']}",
+                "NO": r["no"],
+                "TITLE": r["title"].replace('"', ""),
+                "DIRECTED_BY": r["directed_by"],
+                "WRITTEN_BY": r["written_by"],
+            }
+            for r in csv.DictReader(f, delimiter="\t")
+        ]
+    with open(DATA_DIR / "actors" / "actors_and_characters.tsv", encoding="utf-8") as f:
+        cast = [
+            {
+                SEARCH_COLUMN: f"Actor and character they played: {r['who']}"
+                f"\n\n\nHistory of the engagement: \n{r['history']}",
+                "WHO": r["who"],
+                "DESCRIPTION": r["history"],
+            }
+            for r in csv.DictReader(f, delimiter="\t")
+        ]
+    return {"ACOLYTE_PLOT_SVC_EPISODES": episodes, "ACOLYTE_PLOT_SVC_CAST": cast}
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class FakeCortexSearchService:
+    """
+    Stand-in for a cortex search service, ranking documents
+    with TF-IDF over the words of the query.
+    """
+
+    def __init__(self, documents: List[dict], stats: StageStats, latency: LatencyModel):
+        self.documents = documents
+        self.stats = stats
+        self.latency = latency
+        self.document_words = [Counter(tokenize(d[SEARCH_COLUMN])) for d in documents]
+        document_frequency = Counter(w for words in self.document_words for w in words)
+        self.idf = {w: math.log(1 + len(documents) / df) for w, df in document_frequency.items()}
+
+    def search(self, query: str, columns: list, limit: int, **kwargs):
+        started_at = time.perf_counter()
+        query_words = set(tokenize(query))
+        scores = [
+            sum(words[w] * self.idf.get(w, 0) for w in query_words) for words in self.document_words
+        ]
+        ranking = sorted(range(len(self.documents)), key=lambda i: -scores[i])
+        time.sleep(self.latency.search_seconds)
+        self.stats.record("search", time.perf_counter() - started_at, estimate_tokens(query))
+        return SimpleNamespace(
+            results=[
+                {c: self.documents[i][c] for c in columns or [SEARCH_COLUMN]}
+                for i in ranking[:limit]
+            ]
+        )
+
+    @property
+    def attribute_columns(self) -> str:
+        return ", ".join(c for c in self.documents[0] if c != SEARCH_COLUMN)
+
+
+class FakeRow(dict):
+    """
+    Stand-in for a Snowpark row, accessible by column name or position.
+    """
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return super().__getitem__(key)
+
+    def as_dict(self) -> dict:
+        return dict(self)
+
+
+class FakeAsyncJob:
+    """
+    Stand-in for a Snowpark async job, computing its rows when its result
+    is read. Cancelling it stops the computation.
+    """
+
+    def __init__(self, compute: Callable[[threading.Event], List[FakeRow]]):
+        self.compute = compute
+        self.cancelled = threading.Event()
+
+    def result(self) -> List[FakeRow]:
+        return self.compute(self.cancelled)
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class FakeDataFrame:
+    """
+    Stand-in for a Snowpark dataframe, with its rows, or a function
+    computing them until the given event is set.
+    """
+
+    def __init__(self, rows: Union[List[FakeRow], Callable[[threading.Event], List[FakeRow]]]):
+        self.rows = rows
+
+    def collect(self) -> List[FakeRow]:
+        return self.collect_nowait().result()
+
+    def collect_nowait(self) -> FakeAsyncJob:
+        if callable(self.rows):
+            return FakeAsyncJob(self.rows)
+        return FakeAsyncJob(lambda cancelled: self.rows)
+
+
+def fake_answer(prompt: str, answer_tokens: int) -> List[str]:
+    """
+    Generate a deterministic answer to the prompt, as a list of words.
+    Questions are always routed to the answer based on the series data.
+
+    Args:
+        prompt (str): The prompt sent to the model.
+        answer_tokens (int): The number of words of the answer.
+
+    Returns:
+        list: The words of the answer.
+    """
+    if classify_prompt(prompt) == "router":
+        return ["SERIES"]
+    words = tokenize(prompt) or ["answer"]
+    return [words[(i * 7) % len(words)] for i in range(answer_tokens)]
+
+
+class FakeCortex:
+    """
+    Local stand-in for the Snowflake services used by the chat application:
+    the Snowpark session running `snowflake.cortex.complete` and SHOW
+    commands, the `snowflake.cortex.Complete` streaming function and the
+    `snowflake.core.Root` giving access to cortex search services.
+    """
+
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+        self.stats = StageStats()
+        self.services = {
+            name: FakeCortexSearchService(documents, self.stats, latency)
+            for name, documents in load_documents().items()
+        }
+
+    def sql(self, query: str, params: tuple = None) -> FakeDataFrame:
+        if query.startswith("SHOW CORTEX SEARCH SERVICES"):
+            self.stats.record("metadata", 0)
+            return FakeDataFrame(
+                [
+                    FakeRow(
+                        name=name,
+                        search_column=SEARCH_COLUMN,
+                        target_lag=TARGET_LAG,
+                        attribute_columns=service.attribute_columns,
+                    )
+                    for name, service in self.services.items()
+                ]
+            )
+        if "cortex.complete" in query.lower():
+            model, prompt = params
+            return FakeDataFrame(
+                lambda cancelled: [
+                    FakeRow(response="".join(self.complete_stream(model, prompt, cancelled)))
+                ]
+            )
+        return FakeDataFrame([])
+
+    def complete_stream(
+        self, model: str, prompt: str, cancelled: threading.Event = None
+    ) -> Iterator[str]:
+        started_at = time.perf_counter()
+        time.sleep(self.latency.time_to_first_token(prompt))
+        for i, word in enumerate(fake_answer(prompt, self.latency.answer_tokens)):
+            if cancelled is not None and cancelled.is_set():
+                raise RuntimeError("SQL execution canceled")
+            time.sleep(self.latency.seconds_per_answer_token())
+            yield word if i == 0 else f" {word}"
+        self.stats.record(
+            classify_prompt(prompt), time.perf_counter() - started_at, estimate_tokens(prompt)
+        )
+
+    def Complete(self, model: str, prompt: str, session=None, stream: bool = False, **kwargs):
+        if stream:
+            return self.complete_stream(model, prompt)
+        return "".join(self.complete_stream(model, prompt))
+
+    def Root(self, session) -> SimpleNamespace:
+        schema = SimpleNamespace(cortex_search_services=self.services)
+        return SimpleNamespace(
+            databases=defaultdict(lambda: SimpleNamespace(schemas=defaultdict(lambda: schema)))
+        )
@@ -18,7 +18,10 @@ FROM ACOLYTE_DB.DEV.CAST_AND_CHARACTERS
 ;
 
 
-CREATE OR REPLACE CORTEX SEARCH SERVICE ACOLYTE_DB.DEV.ACOLYTE_PLOT_SVC_CAST
+-- The service is created once. Refresh the table with only the changed rows,
+-- and the service picks them up within its target lag:
+--   python data/refresh_tables.py cast data/actors/actors_and_characters_second_half.tsv
+CREATE CORTEX SEARCH SERVICE IF NOT EXISTS ACOLYTE_DB.DEV.ACOLYTE_PLOT_SVC_CAST
 ON listing_text
 ATTRIBUTES WHO, DESCRIPTION
 WAREHOUSE = ACOLYTE_WH
@@ -38,3 +41,28 @@ FROM ACOLYTE_DB.DEV.CAST_AND_CHARACTERS
 SHOW CORTEX SEARCH SERVICES;
 DESCRIBE CORTEX SEARCH SERVICE ACOLYTE_DB.dev.ACOLYTE_PLOT_SVC_CAST;
 -- DROP CORTEX SEARCH SERVICE ACOLYTE_DB.dev.ACOLYTE_PLOT_SVC_CAST;
+
+
+-- The description split into overlapping windows of sentences, so that a search
+-- hit brings only the relevant part of it to the prompt. The chunk table is
+-- filled by the refresh script together with the CAST_AND_CHARACTERS table.
+CREATE TABLE IF NOT EXISTS ACOLYTE_DB.DEV.CAST_CHUNKS (
+    WHO VARCHAR,
+    CHUNK_NO NUMBER,
+    CHUNK VARCHAR
+);
+
+CREATE CORTEX SEARCH SERVICE IF NOT EXISTS ACOLYTE_DB.SERVICES.ACOLYTE_PLOT_SVC_CAST_CHUNKS
+ON listing_text
+ATTRIBUTES WHO
+WAREHOUSE = ACOLYTE_WH
+TARGET_LAG = '1 hour'
+AS
+SELECT
+    WHO,
+    CONCAT(
+    'Actor and character they played: ' || WHO,
+    '\n\n\nHistory of the engagement: \n' || CHUNK
+    ) as listing_text
+FROM ACOLYTE_DB.DEV.CAST_CHUNKS
+;
@@ -24,7 +24,10 @@ FROM ACOLYTE_DB.DEV.EPISODES
 ;
 
 
-CREATE OR REPLACE CORTEX SEARCH SERVICE ACOLYTE_DB.DEV.ACOLYTE_PLOT_SVC_EPISODES
+-- The service is created once. Refresh the table with only the changed rows,
+-- and the service picks them up within its target lag:
+--   python data/refresh_tables.py episodes data/episodes/season_1-episodes_5-8.tsv
+CREATE CORTEX SEARCH SERVICE IF NOT EXISTS ACOLYTE_DB.DEV.ACOLYTE_PLOT_SVC_EPISODES
 ON listing_text
 ATTRIBUTES NO, TITLE, DIRECTED_BY, WRITTEN_BY
 WAREHOUSE = ACOLYTE_WH
@@ -50,3 +53,31 @@ FROM ACOLYTE_DB.DEV.EPISODES
 SHOW CORTEX SEARCH SERVICES;
 DESCRIBE CORTEX SEARCH SERVICE ACOLYTE_DB.dev.ACOLYTE_PLOT_SVC_EPISODES;
 -- DROP CORTEX SEARCH SERVICE ACOLYTE_DB.dev.ACOLYTE_PLOT_SVC_EPISODES;
+
+
+-- The plot split into overlapping windows of sentences, so that a search hit
+-- brings only the relevant part of the plot to the prompt. The chunk table is
+-- filled by the refresh script together with the EPISODES table.
+CREATE TABLE IF NOT EXISTS ACOLYTE_DB.DEV.EPISODE_CHUNKS (
+    NO VARCHAR,
+    TITLE VARCHAR,
+    CHUNK_NO NUMBER,
+    CHUNK VARCHAR
+);
+
+CREATE CORTEX SEARCH SERVICE IF NOT EXISTS ACOLYTE_DB.SERVICES.ACOLYTE_PLOT_SVC_EPISODE_CHUNKS
+ON listing_text
+ATTRIBUTES NO, TITLE
+WAREHOUSE = ACOLYTE_WH
+TARGET_LAG = '1 hour'
+AS
+SELECT
+    NO,
+    REPLACE(TITLE, '"', '') as TITLE,
+    CONCAT(
+        'The Acolyte, eposode ' || NO,
+        ', ' || REPLACE(TITLE, '"', ''),
+        '\n\n\nPlot: \n' || CHUNK
+    ) as listing_text
+FROM ACOLYTE_DB.DEV.EPISODE_CHUNKS
+;
@@ -0,0 +1,321 @@
+"""
+Refresh the source tables of the cortex search services from the TSV files
+in `data/`, changing only the rows that differ. Every row is keyed on `no`
+for episodes or `who` for the cast, and carries a hash of its content in the
+ROW_HASH column. Only new, changed and, with `--delete-missing`, removed rows
+are uploaded and applied with a single MERGE, so the existing search services
+pick the change up on their next refresh instead of being created again.
+
+The plot of every episode and the description of every cast member are also
+split into overlapping windows of sentences, in a chunk table indexed by its
+own search service, so a search hit brings only the relevant sentences to the
+prompt. The chunks of the changed rows are replaced with the same refresh.
+
+Usage:
+    python data/refresh_tables.py episodes data/episodes/season_1-episodes_1-4.tsv
+    python data/refresh_tables.py cast data/actors/actors_and_characters.tsv --delete-missing
+"""
+
+import argparse
+import csv
+import hashlib
+import re
+import uuid
+from pathlib import Path
+from typing import Dict, List
+
+CHUNK_SENTENCES = 3
+CHUNK_OVERLAP_SENTENCES = 1
+
+SOURCES = {
+    "episodes": {
+        "table": "ACOLYTE_DB.DEV.EPISODES",
+        "key": "NO",
+        # Column of the table by column of the file.
+        "columns": {
+            "no": "NO",
+            "title": "TITLE",
+            "directed_by": "DIRECTED_BY",
+            "written_by": "WRITTEN_BY",
+            "original_release_date": "ORIGINAL_RELEASE_DATE",
+            "plot": "PLOT",
+        },
+        "chunks": {
+            "table": "ACOLYTE_DB.DEV.EPISODE_CHUNKS",
+            "text": "PLOT",
+            "attributes": ["NO", "TITLE"],
+        },
+    },
+    "cast": {
+        "table": "ACOLYTE_DB.DEV.CAST_AND_CHARACTERS",
+        "key": "WHO",
+        "columns": {"who": "WHO", "history": "DESCRIPTION"},
+        "chunks": {
+            "table": "ACOLYTE_DB.DEV.CAST_CHUNKS",
+            "text": "DESCRIPTION",
+            "attributes": ["WHO"],
+        },
+    },
+}
+
+
+def row_hash(row: dict, columns: List[str]) -> str:
+    """
+    Compute the hash of the content of a row.
+
+    Args:
+        row (dict): The row, by column name.
+        columns (list): The columns to hash, in order.
+
+    Returns:
+        str: The SHA-256 hex digest of the values of the columns.
+    """
+    content = "\x1f".join(str(row[c]) for c in columns)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def read_rows(paths: List[Path], source: dict) -> Dict[str, dict]:
+    """
+    Read the rows of the TSV files, with the columns renamed to the columns
+    of the table and the hash of their content. Rows of later files replace
+    rows of earlier files with the same key.
+
+    Args:
+        paths (list): The TSV files, with a header.
+        source (dict): The table, key and columns of the source.
+
+    Returns:
+        dict: The rows by key.
+    """
+    columns = list(source["columns"].values())
+    rows = {}
+    for path in paths:
+        with open(path, encoding="utf-8", newline="") as f:
+            for record in csv.DictReader(f, delimiter="\t"):
+                row = {column: record[name].strip() for name, column in source["columns"].items()}
+                row["ROW_HASH"] = row_hash(row, columns)
+                rows[row[source["key"]]] = row
+    return rows
+
+
+def plan_changes(rows: Dict[str, dict], hashes: Dict[str, str], delete_missing: bool) -> dict:
+    """
+    Compare the rows read from the files with the hashes of the rows
+    in the table.
+
+    Args:
+        rows (dict): The rows read from the files, by key.
+        hashes (dict): The hashes of the rows in the table, by key.
+        delete_missing (bool): Delete rows of the table missing from the files.
+
+    Returns:
+        dict: The keys to insert, update and delete, and the number of unchanged rows.
+    """
+    return {
+        "insert": [k for k in rows if k not in hashes],
+        "update": [k for k in rows if k in hashes and hashes[k] != rows[k]["ROW_HASH"]],
+        "delete": [k for k in hashes if k not in rows] if delete_missing else [],
+        "unchanged": sum(1 for k in rows if hashes.get(k) == rows[k]["ROW_HASH"]),
+    }
+
+
+def sentence_windows(text: str) -> List[str]:
+    """
+    Split a text into overlapping windows of consecutive sentences.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        list: The windows of sentences, or the whole text if it is a single window.
+    """
+    sentences = re.split(r'(?<=[.!?])\s+(?=[A-Z0-9"])', text.strip())
+    step = CHUNK_SENTENCES - CHUNK_OVERLAP_SENTENCES
+    return [
+        " ".join(sentences[i : i + CHUNK_SENTENCES])
+        for i in range(0, max(1, len(sentences) - CHUNK_OVERLAP_SENTENCES), step)
+    ]
+
+
+def create_table(session, source: dict):
+    """
+    Create the table of the source if it does not exist,
+    and add the ROW_HASH column to a table created without it.
+
+    Args:
+        session: The Snowpark session to run the queries with.
+        source (dict): The table, key and columns of the source.
+    """
+    columns = ", ".join(f"{c} VARCHAR" for c in source["columns"].values())
+    session.sql(
+        f"CREATE TABLE IF NOT EXISTS {source['table']} ({columns}, ROW_HASH VARCHAR)"
+    ).collect()
+    session.sql(
+        f"ALTER TABLE {source['table']} ADD COLUMN IF NOT EXISTS ROW_HASH VARCHAR"
+    ).collect()
+    chunks = source["chunks"]
+    attributes = ", ".join(f"{c} VARCHAR" for c in chunks["attributes"])
+    session.sql(
+        f"CREATE TABLE IF NOT EXISTS {chunks['table']} "
+        f"({attributes}, CHUNK_NO NUMBER, CHUNK VARCHAR)"
+    ).collect()
+
+
+def fetch_hashes(session, source: dict) -> Dict[str, str]:
+    """
+    Fetch the hashes of the rows in the table of the source. Rows loaded
+    before hashes were kept have no hash, and count as changed, as do all
+    the rows of a table without the ROW_HASH column, in a dry run.
+
+    Args:
+        session: The Snowpark session to run the queries with.
+        source (dict): The table, key and columns of the source.
+
+    Returns:
+        dict: The hashes of the rows by key.
+    """
+    hash_columns = session.sql(f"SHOW COLUMNS LIKE 'ROW_HASH' IN TABLE {source['table']}").collect()
+    hash_column = "ROW_HASH" if hash_columns else "NULL"
+    rows = session.sql(f"SELECT {source['key']}, {hash_column} FROM {source['table']}").collect()
+    return {str(row[0]): row[1] for row in rows}
+
+
+def fetch_chunked_keys(session, source: dict) -> set:
+    """
+    Fetch the keys of the rows that have chunks in the chunk table of the source.
+
+    Args:
+        session: The Snowpark session to run the query with.
+        source (dict): The table, key, columns and chunk table of the source.
+
+    Returns:
+        set: The keys of the rows with chunks.
+    """
+    rows = session.sql(
+        f"SELECT DISTINCT {source['key']} FROM {source['chunks']['table']}"
+    ).collect()
+    return {str(row[0]) for row in rows}
+
+
+def merge_changes(session, source: dict, rows: Dict[str, dict], changes: dict):
+    """
+    Upload the changed rows to a temporary table, and apply them
+    to the table of the source with a single MERGE.
+
+    Args:
+        session: The Snowpark session to run the queries with.
+        source (dict): The table, key and columns of the source.
+        rows (dict): The rows read from the files, by key.
+        changes (dict): The keys to insert, update and delete.
+    """
+    columns = [*source["columns"].values(), "ROW_HASH"]
+    key = source["key"]
+    staged = [
+        ["UPSERT", *[rows[k][c] for c in columns]] for k in changes["insert"] + changes["update"]
+    ] + [["DELETE", *[k if c == key else None for c in columns]] for k in changes["delete"]]
+    if not staged:
+        return
+
+    changes_table = f"ACOLYTE_REFRESH_{uuid.uuid4().hex[:8].upper()}"
+    session.create_dataframe(staged, schema=["ACTION", *columns]).write.save_as_table(
+        changes_table, mode="overwrite", table_type="temporary"
+    )
+    session.sql(
+        f"""
+        MERGE INTO {source['table']} t
+        USING {changes_table} s
+        ON t.{key} = s.{key}
+        WHEN MATCHED AND s.ACTION = 'DELETE' THEN DELETE
+        WHEN MATCHED THEN UPDATE SET {", ".join(f"t.{c} = s.{c}" for c in columns if c != key)}
+        WHEN NOT MATCHED AND s.ACTION = 'UPSERT' THEN
+            INSERT ({", ".join(columns)}) VALUES ({", ".join(f"s.{c}" for c in columns)})
+        """
+    ).collect()
+
+
+def replace_chunks(session, source: dict, rows: Dict[str, dict], keys: List[str]):
+    """
+    Replace the chunks of the given rows in the chunk table of the source,
+    deleting the chunks of the rows that are no longer in the files.
+
+    Args:
+        session: The Snowpark session to run the queries with.
+        source (dict): The table, key, columns and chunk table of the source.
+        rows (dict): The rows read from the files, by key.
+        keys (list): The keys of the rows to chunk again.
+    """
+    if not keys:
+        return
+    chunks = source["chunks"]
+    key = source["key"]
+    keys_table = f"ACOLYTE_REFRESH_KEYS_{uuid.uuid4().hex[:8].upper()}"
+    session.create_dataframe([[k] for k in keys], schema=[key]).write.save_as_table(
+        keys_table, mode="overwrite", table_type="temporary"
+    )
+    session.sql(
+        f"DELETE FROM {chunks['table']} c USING {keys_table} k WHERE c.{key} = k.{key}"
+    ).collect()
+    chunk_rows = [
+        [*[rows[k][c] for c in chunks["attributes"]], i, chunk]
+        for k in keys
+        if k in rows
+        for i, chunk in enumerate(sentence_windows(rows[k][chunks["text"]]))
+    ]
+    if chunk_rows:
+        session.create_dataframe(
+            chunk_rows, schema=[*chunks["attributes"], "CHUNK_NO", "CHUNK"]
+        ).write.save_as_table(chunks["table"], mode="append")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", choices=SOURCES, help="The table to refresh.")
+    parser.add_argument("files", nargs="+", type=Path, help="TSV files with a header.")
+    parser.add_argument("--connection", help="Name of the connection in connections.toml.")
+    parser.add_argument("--table", help="Table to refresh, if not the default of the source.")
+    parser.add_argument(
+        "--delete-missing",
+        action="store_true",
+        help="Delete rows missing from the files, when the files hold the whole source.",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only print the changes, without applying them."
+    )
+    args = parser.parse_args()
+
+    from snowflake.snowpark import Session
+
+    source = dict(SOURCES[args.source], table=args.table or SOURCES[args.source]["table"])
+    builder = Session.builder
+    if args.connection:
+        builder = builder.config("connection_name", args.connection)
+    session = builder.create()
+
+    rows = read_rows(args.files, source)
+    if not args.dry_run:
+        create_table(session, source)
+    changes = plan_changes(rows, fetch_hashes(session, source), args.delete_missing)
+    # Rows loaded before the chunk table existed are chunked too.
+    chunked_keys = fetch_chunked_keys(session, source) if not args.dry_run else set(rows)
+    chunk_keys = list(
+        dict.fromkeys(
+            [
+                *changes["insert"],
+                *changes["update"],
+                *changes["delete"],
+                *[k for k in rows if k not in chunked_keys],
+            ]
+        )
+    )
+    if not args.dry_run:
+        merge_changes(session, source, rows, changes)
+        replace_chunks(session, source, rows, chunk_keys)
+    print(
+        f"{source['table']}: {len(changes['insert'])} inserted, {len(changes['update'])} updated, "
+        f"{len(changes['delete'])} deleted, {changes['unchanged']} unchanged."
+    )
+    print(f"{source['chunks']['table']}: chunks of {len(chunk_keys)} rows replaced.")
+
+
+if __name__ == "__main__":
+    main()
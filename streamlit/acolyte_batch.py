@@ -0,0 +1,238 @@
+"""
+Answer a batch of questions with the pipeline of The Acolyte chat, for bulk
+evaluation after a data refresh. The context of every question is retrieved
+with the engine, then every pipeline stage is a single set-based query:
+
+    SELECT ID, SNOWFLAKE.CORTEX.COMPLETE(?, PROMPT) FROM <prompts table>
+
+instead of one query per prompt. Questions are answered without chat history.
+
+Usage:
+    python streamlit/acolyte_batch.py --questions questions.txt --output answers.jsonl
+    python streamlit/acolyte_batch.py --questions-table EVAL.QUESTIONS --output-table EVAL.ANSWERS
+"""
+
+import argparse
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List
+
+from acolyte_engine import (
+    SESSION_POOL_SIZE,
+    Engine,
+    PipelineSettings,
+    SessionPool,
+    create_aggregation_prompt,
+    create_generic_prompt,
+    create_router_prompt,
+    create_specialized_prompt,
+    is_unknown_answer,
+    parse_option,
+    parse_route,
+)
+
+SEARCH_WORKERS = 8
+
+
+def load_questions(session, path: Path = None, table: str = None) -> List[str]:
+    """
+    Load the questions from a file, with one question per line, or a JSON
+    object with a "question" key per line for `.jsonl` files, or from the
+    QUESTION column of a table.
+
+    Args:
+        session: The Snowpark session to query the table with.
+        path (Path): The file with the questions.
+        table (str): The table with the questions.
+
+    Returns:
+        list: The questions.
+    """
+    if table is not None:
+        return [row[0] for row in session.sql(f"SELECT QUESTION FROM {table}").collect()]
+    lines = [line.strip() for line in path.read_text(encoding="utf-8").splitlines()]
+    if path.suffix == ".jsonl":
+        return [json.loads(line)["question"] for line in lines if line]
+    return [line for line in lines if line]
+
+
+def complete_in_batch(session, stage: str, model: str, prompts: Dict[int, str]) -> Dict[int, str]:
+    """
+    Generate the completions of all the prompts of a pipeline stage with
+    a single query over a temporary table of the prompts.
+
+    Args:
+        session: The Snowpark session to run the query with.
+        stage (str): The name of the pipeline stage, used in the table name.
+        model (str): The name of the model to use for completion.
+        prompts (dict): The prompts by question ID.
+
+    Returns:
+        dict: The completions by question ID.
+    """
+    if not prompts:
+        return {}
+    table = f"ACOLYTE_BATCH_{stage.upper()}_{uuid.uuid4().hex[:8].upper()}"
+    session.create_dataframe(
+        [[i, prompt] for i, prompt in prompts.items()], schema=["ID", "PROMPT"]
+    ).write.save_as_table(table, mode="overwrite", table_type="temporary")
+    rows = session.sql(
+        f"SELECT ID, SNOWFLAKE.CORTEX.COMPLETE(?, PROMPT) FROM {table}", (model,)
+    ).collect()
+    return {row[0]: row[1] for row in rows}
+
+
+def answer_questions(engine: Engine, questions: List[str], settings: PipelineSettings) -> list:
+    """
+    Answer the questions with the pipeline selected in the settings,
+    running every stage for all the questions that need it at once.
+
+    Args:
+        engine (Engine): The engine to retrieve the context with.
+        questions (list): The questions to answer.
+        settings (PipelineSettings): The options of the answer pipeline.
+
+    Returns:
+        list: The question, route, intermediate answers and answer of every question.
+    """
+    ids = range(len(questions))
+
+    def complete_stage(stage: str, model: str, prompts: Dict[int, str]) -> Dict[int, str]:
+        with engine.sessions.checkout() as session:
+            return complete_in_batch(session, stage, model, prompts)
+
+    routes = {i: "both" if settings.answer_pipeline == "Full merge" else "series" for i in ids}
+    if settings.answer_pipeline == "Route with classifier":
+        responses = complete_stage(
+            "router",
+            settings.model_name__router,
+            {i: create_router_prompt(questions[i], "") for i in ids},
+        )
+        routes = {i: parse_route(responses[i]) for i in ids}
+
+    rag_ids = [i for i in ids if routes[i] != "generic"]
+    with ThreadPoolExecutor(SEARCH_WORKERS) as executor:
+        contexts = dict(
+            zip(
+                rag_ids,
+                executor.map(
+                    lambda i: engine.query_cortex_search_service(questions[i], settings), rag_ids
+                ),
+            )
+        )
+    answers_rag = complete_stage(
+        "rag",
+        settings.model_name__service,
+        {i: create_specialized_prompt(questions[i], "", contexts[i]) for i in rag_ids},
+    )
+
+    generic_ids = [
+        i
+        for i in ids
+        if routes[i] != "series" or is_unknown_answer(answers_rag.get(i, "I do not know"))
+    ]
+    answers_generic = complete_stage(
+        "generic",
+        settings.model_name__generic,
+        {i: create_generic_prompt(questions[i], "") for i in generic_ids},
+    )
+
+    answers_aggregation = complete_stage(
+        "aggregation",
+        settings.model_name__aggregation,
+        {
+            i: create_aggregation_prompt(questions[i], answers_generic[i], answers_rag[i], "")
+            for i in ids
+            if routes[i] == "both"
+        },
+    )
+
+    return [
+        {
+            "question": questions[i],
+            "route": routes[i],
+            "answer_generic": answers_generic.get(i),
+            "answer_rag": answers_rag.get(i),
+            "answer": answers_aggregation.get(i) or answers_generic.get(i) or answers_rag.get(i),
+        }
+        for i in ids
+    ]
+
+
+def write_results(session, results: list, path: Path = None, table: str = None):
+    """
+    Write the answers to a JSONL file, or append them to a table
+    together with the ID and the time of the run.
+
+    Args:
+        session: The Snowpark session to write the table with.
+        results (list): The question, route, intermediate answers and answer of every question.
+        path (Path): The JSONL file to write.
+        table (str): The table to append to.
+    """
+    if table is None:
+        with open(path, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+        return
+
+    run_id = uuid.uuid4().hex
+    created_on = datetime.now(timezone.utc).isoformat()
+    columns = ["question", "route", "answer_generic", "answer_rag", "answer"]
+    session.create_dataframe(
+        [[run_id, created_on, *[r[c] for c in columns]] for r in results],
+        schema=["RUN_ID", "CREATED_ON", *[c.upper() for c in columns]],
+    ).write.save_as_table(table, mode="append")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    questions = parser.add_mutually_exclusive_group(required=True)
+    questions.add_argument("--questions", type=Path, help="File with one question per line.")
+    questions.add_argument("--questions-table", help="Table with a QUESTION column.")
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--output", type=Path, help="JSONL file to write the answers to.")
+    output.add_argument("--output-table", help="Table to append the answers to.")
+    parser.add_argument("--connection", help="Name of the connection in connections.toml.")
+    parser.add_argument(
+        "--sessions", type=int, default=SESSION_POOL_SIZE, help="Size of the session pool."
+    )
+    parser.add_argument(
+        "--service", help="Cortex search service to use, all services if not given."
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override an option of the pipeline, e.g. answer_pipeline='Route on RAG answer'.",
+    )
+    args = parser.parse_args()
+
+    from snowflake.snowpark import Session
+
+    builder = Session.builder
+    if args.connection:
+        builder = builder.config("connection_name", args.connection)
+    engine = Engine(SessionPool(builder.create, args.sessions))
+    settings = PipelineSettings.from_mapping(
+        {
+            "selected_cortex_search_service": args.service,
+            "search_all_services": args.service is None,
+            **dict(parse_option(o) for o in args.set),
+        }
+    )
+
+    with engine.sessions.checkout() as session:
+        questions = load_questions(session, args.questions, args.questions_table)
+    results = answer_questions(engine, questions, settings)
+    with engine.sessions.checkout() as session:
+        write_results(session, results, args.output, args.output_table)
+    print(f"Answered {len(results)} questions.")
+
+
+if __name__ == "__main__":
+    main()
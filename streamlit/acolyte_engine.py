@@ -0,0 +1,3255 @@
+"""
+Question answering pipeline of The Acolyte chat, independent of Streamlit.
+
+Every question is submitted to the `Engine` as a `Job` with its own ID, and
+answered in a background thread: the chat history summary, the search, the
+generic and RAG answers and their aggregation. The Streamlit application only
+polls the jobs and renders their answers, so a rerun of the script never
+throws away the calls in flight. The engine can also be driven from the
+command line, with a Snowflake connection from `connections.toml`:
+
+    python streamlit/acolyte_engine.py "Who is Sol?" "Which actor was playing Sol?"
+"""
+
+import argparse
+import contextvars
+import csv
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, fields, replace
+from datetime import datetime, timezone
+from textwrap import dedent
+from typing import Callable, Hashable, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+from snowflake.core import Root
+from snowflake.core.exceptions import APIError
+from snowflake.cortex import Complete
+
+# The traces written to the event table are logged at INFO level,
+# which would be dropped by the default WARNING level.
+logger = logging.getLogger("acolyte_chat")
+logger.setLevel(logging.INFO)
+
+MODELS = [
+    "llama3.1-70b",
+    "mistral-large2",
+    "llama3.1-8b",
+    "mixtral-8x7b",
+]
+MODEL_CONTEXT_WINDOWS = {
+    "llama3.1-70b": 128000,
+    "mistral-large2": 128000,
+    "llama3.1-8b": 128000,
+    "mixtral-8x7b": 32000,
+}
+# Models to fall back to when a model is too slow or fails, from the
+# slowest to the fastest, so that the cascade caps the tail latency.
+FALLBACK_MODELS = {
+    "llama3.1-70b": ["llama3.1-8b"],
+    "mistral-large2": ["llama3.1-70b", "llama3.1-8b"],
+    "llama3.1-8b": [],
+    "mixtral-8x7b": ["llama3.1-8b"],
+}
+CHARS_PER_TOKEN = 4
+PROMPT_RESERVED_TOKENS = 4096
+NEAR_DUPLICATE_SIMILARITY = 0.9
+SERVICE_DB = "ACOLYTE_DB"
+SERVICE_SCHEMA = "SERVICES"
+SERVICE_DB_SCHEMA = f"{SERVICE_DB}.{SERVICE_SCHEMA}"
+# Services indexing windows of sentences of the documents indexed whole
+# by the other services. They are left out when searching all services,
+# so the same passages are not retrieved twice.
+CHUNK_SERVICE_SUFFIX = "_CHUNKS"
+COMPLETION_CACHE_TABLE = f"{SERVICE_DB_SCHEMA}.COMPLETION_CACHE"
+COMPLETION_CACHE_BACKENDS = [
+    "In-process",
+    "In-process + Snowflake table",
+    "Off",
+]
+COMPLETION_CACHE_SIZE = 1000
+COMPLETION_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+ANSWER_PIPELINES = [
+    "Full merge",
+    "Route on RAG answer",
+    "Route with classifier",
+]
+UNKNOWN_ANSWER_MAX_CHARS = 200
+TRACE_SINKS = [
+    "Nowhere",
+    "Event table",
+    "JSONL file",
+]
+TRACE_FILE = os.path.join(tempfile.gettempdir(), "acolyte_chat_traces.jsonl")
+HISTORY_STORES = [
+    "SQLite file",
+    "Snowflake table",
+]
+HISTORY_FILE = os.path.join(tempfile.gettempdir(), "acolyte_chat_history.sqlite3")
+HISTORY_TABLE = f"{SERVICE_DB_SCHEMA}.CHAT_HISTORY"
+HISTORY_RING_SIZE = 60
+HISTORY_RETENTION_SECONDS = 7 * 24 * 60 * 60
+HISTORY_PRUNE_INTERVAL_SECONDS = 10 * 60
+RETRIEVAL_BACKENDS = [
+    "Cortex Search",
+    "Local index",
+]
+LOCAL_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+LOCAL_DATA_FILES = [
+    os.path.join("episodes", "season_1-all_episodes.tsv"),
+    os.path.join("actors", "actors_and_characters.tsv"),
+]
+LOCAL_INDEX_DIR = os.path.join(tempfile.gettempdir(), "acolyte_local_index")
+LOCAL_SOURCE_TABLES_QUERY = """
+    SELECT TABLE_NAME, ROW_COUNT, LAST_ALTERED
+    FROM ACOLYTE_DB.INFORMATION_SCHEMA.TABLES
+    WHERE TABLE_SCHEMA = 'DEV' AND TABLE_NAME IN ('EPISODES', 'CAST_AND_CHARACTERS')
+    ORDER BY TABLE_NAME
+"""
+LOCAL_INDEX_QUERIES = [
+    """
+    SELECT CONCAT(
+        'The Acolyte, eposode ' || NO,
+        ', directed by ' || DIRECTED_BY,
+        ', written by ' || WRITTEN_BY,
+        ', released on ' || ORIGINAL_RELEASE_DATE,
+        '\n\n\nPlot: \n' || PLOT
+    ) as listing_text
+    FROM ACOLYTE_DB.DEV.EPISODES
+    """,
+    """
+    SELECT CONCAT(
+        'Actor and character they played: ' || WHO,
+        '\n\n\nHistory of the engagement: \n' || DESCRIPTION
+    ) as listing_text
+    FROM ACOLYTE_DB.DEV.CAST_AND_CHARACTERS
+    """,
+]
+LOCAL_CHUNK_WORDS = 150
+LOCAL_CHUNK_OVERLAP_WORDS = 30
+BM25_K1 = 1.2
+BM25_B = 0.75
+RERANK_LEXICAL_WEIGHT = 0.5
+ATTRIBUTE_MATCH_BOOST = 0.5
+RECIPROCAL_RANK_FUSION_K = 60
+STOP_WORDS = set(
+    """
+    a about after all also an and any are as at be been before being but by can could
+    did do does during each for from had has have he her hers him his how i if in into
+    is it its me more most my no not of on or other our out she so some than that the
+    their them then there these they this those to up was we were what when where which
+    while who whom why will with would you your
+    """.split()
+)
+EPISODE_ORDINALS = ["first", "second", "third", "fourth", "fifth", "sixth", "seventh", "eighth"]
+DEFAULT_TARGET_LAG_SECONDS = 60 * 60
+SERVICE_METADATA_REFRESH_SECONDS = 5 * 60
+SEARCH_CACHE_SIZE = 1000
+CACHE_PRUNE_INTERVAL_SECONDS = 10 * 60
+JOB_WORKERS = 16
+COMPLETION_WORKERS = 32
+CANCEL_WORKERS = 2
+STAGE_TIMING_WINDOW = 50
+STAGE_TIMING_MAX_AGE_SECONDS = 5 * 60
+STAGE_TIMING_PERCENTILE = 90
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_CALLS = 20
+SESSION_POOL_SIZE = 8
+SESSION_HEALTH_CHECK_SECONDS = 60
+JOB_HISTORY_SIZE = 1000
+JOB_TTL_SECONDS = 60 * 60
+RENDER_WAIT_SECONDS = 60
+
+
+class TTLCache:
+    """
+    Thread safe, in-process key-value cache. Entries expire after
+    the given time to live, and the least recently used entries
+    are evicted once the cache holds more than `max_size` entries.
+    A reader can also ask for entries younger than a shorter maximum
+    age, without expiring the older ones for other readers.
+    Cache hits and misses are counted.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, max_age_seconds: Optional[float] = None):
+        with self._lock:
+            entry = self._entries.get(key)
+            age_seconds = None if entry is None else time.monotonic() - entry[0]
+            if entry is not None and age_seconds > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            if entry is not None and max_age_seconds is not None and age_seconds > max_age_seconds:
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SnowflakeTableCache:
+    """
+    Key-value cache stored in a Snowflake table, shared by every
+    replica of the application. Entries older than the given time
+    to live, or than the maximum age asked for by the reader, are
+    ignored on read, and overwritten on write. Writes run
+    in the background, one at a time, and delete the expired entries
+    at most every `CACHE_PRUNE_INTERVAL_SECONDS`.
+    """
+
+    def __init__(self, sessions: "SessionPool", table: str, ttl_seconds: float):
+        self.sessions = sessions
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="acolyte-cache-writer")
+        self._pruned_at = None
+        with sessions.checkout() as session:
+            session.sql(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    CACHE_KEY VARCHAR,
+                    RESPONSE VARCHAR,
+                    CREATED_ON TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP()
+                )
+                """
+            ).collect()
+
+    def get(self, key: str, max_age_seconds: Optional[float] = None):
+        if max_age_seconds is None:
+            max_age_seconds = self.ttl_seconds
+        with self.sessions.checkout() as session:
+            rows = session.sql(
+                f"""
+                SELECT RESPONSE FROM {self.table}
+                WHERE CACHE_KEY = ? AND CREATED_ON > DATEADD('second', ?, CURRENT_TIMESTAMP())
+                """,
+                (key, -int(min(max_age_seconds, self.ttl_seconds))),
+            ).collect()
+        return rows[0][0] if rows else None
+
+    def put(self, key: str, value: str):
+        self._writer.submit(self._write, key, value)
+
+    def _write(self, key: str, value: str):
+        try:
+            with self.sessions.checkout() as session:
+                session.sql(
+                    f"""
+                    MERGE INTO {self.table} t
+                    USING (SELECT ? AS CACHE_KEY, ? AS RESPONSE) s ON t.CACHE_KEY = s.CACHE_KEY
+                    WHEN MATCHED THEN UPDATE SET
+                        t.RESPONSE = s.RESPONSE, t.CREATED_ON = CURRENT_TIMESTAMP()
+                    WHEN NOT MATCHED THEN
+                        INSERT (CACHE_KEY, RESPONSE) VALUES (s.CACHE_KEY, s.RESPONSE)
+                    """,
+                    (key, value),
+                ).collect()
+                now = time.monotonic()
+                if self._pruned_at is None or now - self._pruned_at > CACHE_PRUNE_INTERVAL_SECONDS:
+                    session.sql(
+                        f"""
+                        DELETE FROM {self.table}
+                        WHERE CREATED_ON <= DATEADD('second', ?, CURRENT_TIMESTAMP())
+                        """,
+                        (-int(self.ttl_seconds),),
+                    ).collect()
+                    self._pruned_at = now
+        except Exception:
+            logger.exception(f"Could not write to {self.table}")
+
+
+class CompletionCache:
+    """
+    Cache of model completions keyed on the model name and a hash
+    of the normalized prompt. Backends are checked in order, and a hit
+    in a slower backend is copied to all the faster ones. Every reader
+    can ask for completions younger than its own maximum age.
+    """
+
+    def __init__(self, backends: list):
+        self.backends = backends
+
+    @staticmethod
+    def key(model: str, prompt: str) -> str:
+        normalized_prompt = " ".join(prompt.split()).lower()
+        return f"{model}:{hashlib.sha256(normalized_prompt.encode()).hexdigest()}"
+
+    def get(
+        self, model: str, prompt: str, max_age_seconds: Optional[float] = None
+    ) -> Optional[str]:
+        key = self.key(model, prompt)
+        for i, backend in enumerate(self.backends):
+            response = backend.get(key, max_age_seconds)
+            if response is not None:
+                for faster_backend in self.backends[:i]:
+                    faster_backend.put(key, response)
+                return response
+        return None
+
+    def put(self, model: str, prompt: str, response: str):
+        key = self.key(model, prompt)
+        for backend in self.backends:
+            backend.put(key, response)
+
+
+class SingleFlight:
+    """
+    Thread safe coalescing of identical calls. Concurrent calls with the
+    same key share a single in-flight call: the first caller runs it, and
+    the others wait for its result, or its error. Streamed calls are shared
+    the same way, the others following the chunks of the first caller as
+    they are yielded. Nothing is kept once the call is finished. The calls
+    that were collapsed into another are counted.
+    """
+
+    def __init__(self):
+        self.collapsed = 0
+        self._calls = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, call: Callable) -> Tuple[object, bool]:
+        """
+        Run the call, or wait for the in-flight call with the same key.
+
+        Args:
+            key (Hashable): The key of the call.
+            call (Callable): Function without arguments to run.
+
+        Returns:
+            tuple: The result of the call, and whether it was shared with another caller.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            shared = future is not None
+            if shared:
+                self.collapsed += 1
+            else:
+                future = self._calls[key] = Future()
+        if shared:
+            return future.result(), True
+
+        try:
+            result = call()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stream(self, key: Hashable, call: Callable[[], Iterator]) -> Tuple[Iterator, bool]:
+        """
+        Run the streamed call, or follow the in-flight streamed call with
+        the same key, from its first chunk.
+
+        Args:
+            key (Hashable): The key of the call.
+            call (Callable): Function without arguments returning the chunks.
+
+        Returns:
+            tuple: The chunks of the call, and whether they are shared with another caller.
+        """
+        with self._lock:
+            shared_stream = self._streams.get(key)
+            shared = shared_stream is not None
+            if shared:
+                self.collapsed += 1
+            else:
+                shared_stream = self._streams[key] = SharedStream()
+        if shared:
+            return shared_stream.follow(), True
+        return self._lead(key, call, shared_stream), False
+
+    def _lead(self, key: Hashable, call: Callable[[], Iterator], shared_stream: "SharedStream"):
+        error = None
+        try:
+            for chunk in call():
+                shared_stream.write(chunk)
+                yield chunk
+        except GeneratorExit:
+            error = RuntimeError("The shared stream was abandoned by the caller running it.")
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            with self._lock:
+                del self._streams[key]
+            shared_stream.set_done(error)
+
+
+class SharedStream:
+    """
+    Thread safe chunks of a streamed call, written by the caller running
+    it and followed by the callers sharing it.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self._condition = threading.Condition()
+
+    def write(self, chunk):
+        with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+
+    def set_done(self, error: Optional[BaseException] = None):
+        with self._condition:
+            self.done = True
+            self.error = error
+            self._condition.notify_all()
+
+    def follow(self) -> Iterator:
+        """
+        Yield the chunks of the call, from the first one, as soon as they
+        are written. Raise the error of the call if it failed.
+
+        Yields:
+            The next chunk of the call.
+        """
+        position = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self.chunks) > position or self.done)
+                chunks = self.chunks[position:]
+            if chunks:
+                position += len(chunks)
+                yield from chunks
+            elif self.error is None:
+                return
+            else:
+                raise self.error
+
+
+class SessionPool:
+    """
+    Pool of Snowpark sessions shared by all jobs. A session is checked out
+    for the duration of a single call and returned afterwards, so at most
+    `size` calls run at once and the others wait for a free session.
+    Sessions are created on first use. A session idle for longer than
+    `health_check_seconds`, or returned after a failed call, is checked
+    with a trivial query before it is handed out again, and replaced
+    by a new session if the check fails. The failed session is closed,
+    unless the new session is the same one, and the functions registered
+    with `on_close` are called with it.
+    """
+
+    def __init__(
+        self,
+        create_session: Callable,
+        size: int = SESSION_POOL_SIZE,
+        health_check_seconds: float = SESSION_HEALTH_CHECK_SECONDS,
+    ):
+        self.create_session = create_session
+        self.size = size
+        self.health_check_seconds = health_check_seconds
+        self.in_use = 0
+        self.created = 0
+        self.replaced = 0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._close_listeners = []
+
+    def on_close(self, listener: Callable):
+        """
+        Register a function to call with every session closed by the pool,
+        for example to forget the objects bound to it.
+
+        Args:
+            listener (Callable): Function taking the closed session.
+        """
+        self._close_listeners.append(listener)
+
+    def _close(self, session):
+        try:
+            session.close()
+        except Exception:
+            logger.exception("Could not close a failed session")
+        for listener in self._close_listeners:
+            listener(session)
+
+    def _new_session(self):
+        session = self.create_session()
+        with self._lock:
+            self.created += 1
+        return session
+
+    def _idle_session(self):
+        try:
+            session, returned_at = self._idle.get_nowait()
+        except queue.Empty:
+            return self._new_session()
+        if time.monotonic() - returned_at <= self.health_check_seconds:
+            return session
+        try:
+            session.sql("SELECT 1").collect()
+            return session
+        except Exception:
+            with self._lock:
+                self.replaced += 1
+        try:
+            replacement = self._new_session()
+        except BaseException:
+            self._close(session)
+            raise
+        # In Streamlit in Snowflake, the new session is the same active session.
+        if replacement is not session:
+            self._close(session)
+        return replacement
+
+    @contextmanager
+    def checkout(self) -> Iterator:
+        """
+        Check out a healthy session, waiting for one to be returned if all
+        of them are in use. The time spent waiting is added to the span
+        of the current pipeline stage.
+
+        Yields:
+            Session: The Snowpark session, returned to the pool afterwards.
+        """
+        started_at = time.perf_counter()
+        self._slots.acquire()
+        wait_ms = round(1000 * (time.perf_counter() - started_at), 1)
+        if wait_ms >= 1:
+            annotate_span(session_wait_ms=wait_ms)
+        try:
+            session = self._idle_session()
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.in_use += 1
+        failed = False
+        try:
+            yield session
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._idle.put((session, float("-inf") if failed else time.monotonic()))
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+
+class SQLiteHistoryStore:
+    """
+    Store of the chat messages spilled out of memory, in a local SQLite
+    file shared by all sessions of the application process. Messages
+    older than `retention_seconds`, like the ones of closed sessions,
+    are deleted when the store is created, and at most every
+    `HISTORY_PRUNE_INTERVAL_SECONDS` when messages are appended.
+    """
+
+    def __init__(self, path: str, retention_seconds: float = HISTORY_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chat_history (
+                    chat_id TEXT, position INTEGER, role TEXT, content TEXT, created_on REAL,
+                    PRIMARY KEY (chat_id, position)
+                )
+                """
+            )
+            self._prune()
+
+    def _prune(self):
+        self._connection.execute(
+            "DELETE FROM chat_history WHERE created_on <= ?",
+            (time.time() - self.retention_seconds,),
+        )
+        self._pruned_at = time.monotonic()
+
+    def append(self, chat_id: str, position: int, message: dict):
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                INSERT OR REPLACE INTO chat_history (chat_id, position, role, content, created_on)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (chat_id, position, message["role"], message["content"], time.time()),
+            )
+            if time.monotonic() - self._pruned_at > HISTORY_PRUNE_INTERVAL_SECONDS:
+                self._prune()
+
+    def read(self, chat_id: str, start: int, stop: int) -> List[dict]:
+        with self._lock:
+            rows = self._connection.execute(
+                """
+                SELECT role, content FROM chat_history
+                WHERE chat_id = ? AND position >= ? AND position < ? ORDER BY position
+                """,
+                (chat_id, start, stop),
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def delete(self, chat_id: str):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM chat_history WHERE chat_id = ?", (chat_id,))
+
+
+class SnowflakeHistoryStore:
+    """
+    Store of the chat messages spilled out of memory, in a Snowflake
+    table shared by every replica of the application. Writes run in the
+    background, one at a time, and reads wait for the writes before them.
+    Messages older than `retention_seconds`, like the ones of closed
+    sessions, are deleted in the background when the store is created,
+    and at most every `HISTORY_PRUNE_INTERVAL_SECONDS` after a write.
+    """
+
+    def __init__(
+        self,
+        sessions: "SessionPool",
+        table: str,
+        retention_seconds: float = HISTORY_RETENTION_SECONDS,
+    ):
+        self.sessions = sessions
+        self.table = table
+        self.retention_seconds = retention_seconds
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="acolyte-history-writer")
+        self._pruned_at = None
+        with sessions.checkout() as session:
+            session.sql(
+                f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    CHAT_ID VARCHAR,
+                    POSITION NUMBER,
+                    ROLE VARCHAR,
+                    CONTENT VARCHAR,
+                    CREATED_ON TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP()
+                )
+                """
+            ).collect()
+        # Delete the messages left behind by closed sessions.
+        self._writer.submit(self._write)
+
+    def _write(self, query: Optional[str] = None, params: tuple = ()):
+        try:
+            with self.sessions.checkout() as session:
+                if query is not None:
+                    session.sql(query, params).collect()
+                now = time.monotonic()
+                if (
+                    self._pruned_at is None
+                    or now - self._pruned_at > HISTORY_PRUNE_INTERVAL_SECONDS
+                ):
+                    session.sql(
+                        f"""
+                        DELETE FROM {self.table}
+                        WHERE CREATED_ON <= DATEADD('second', ?, CURRENT_TIMESTAMP())
+                        """,
+                        (-int(self.retention_seconds),),
+                    ).collect()
+                    self._pruned_at = now
+        except Exception:
+            logger.exception(f"Could not write to {self.table}")
+
+    def append(self, chat_id: str, position: int, message: dict):
+        self._writer.submit(
+            self._write,
+            f"INSERT INTO {self.table} (CHAT_ID, POSITION, ROLE, CONTENT) VALUES (?, ?, ?, ?)",
+            (chat_id, position, message["role"], message["content"]),
+        )
+
+    def read(self, chat_id: str, start: int, stop: int) -> List[dict]:
+        # Wait for the messages appended so far to be written.
+        self._writer.submit(lambda: None).result()
+        with self.sessions.checkout() as session:
+            rows = session.sql(
+                f"""
+                SELECT ROLE, CONTENT FROM {self.table}
+                WHERE CHAT_ID = ? AND POSITION >= ? AND POSITION < ? ORDER BY POSITION
+                """,
+                (chat_id, start, stop),
+            ).collect()
+        return [{"role": row[0], "content": row[1]} for row in rows]
+
+    def delete(self, chat_id: str):
+        self._writer.submit(self._write, f"DELETE FROM {self.table} WHERE CHAT_ID = ?", (chat_id,))
+
+
+class ChatHistory:
+    """
+    Messages of a single chat. Only the last `ring_size` messages are kept
+    in memory. Older messages are spilled to the store, one by one as new
+    messages arrive, and read back from it a page at a time.
+    Positions of the messages count from the start of the chat.
+    """
+
+    def __init__(self, store, ring_size: int = HISTORY_RING_SIZE):
+        self.chat_id = uuid.uuid4().hex
+        self.store = store
+        self.ring_size = ring_size
+        self.spilled = 0
+        self.recent = deque()
+
+    def __len__(self) -> int:
+        return self.spilled + len(self.recent)
+
+    def append(self, message: dict):
+        self.recent.append(message)
+        while len(self.recent) > self.ring_size:
+            self.store.append(self.chat_id, self.spilled, self.recent.popleft())
+            self.spilled += 1
+
+    def page(self, start: int, stop: int) -> List[dict]:
+        """
+        Read the messages between the given positions, from the store
+        for the ones that are not in memory anymore.
+
+        Args:
+            start (int): The position of the first message.
+            stop (int): The position after the last message.
+
+        Returns:
+            list: The messages.
+        """
+        start, stop = max(0, start), min(stop, len(self))
+        messages = []
+        if start < min(stop, self.spilled):
+            messages = self.store.read(self.chat_id, start, min(stop, self.spilled))
+        recent = list(self.recent)
+        return messages + recent[max(0, start - self.spilled) : max(0, stop - self.spilled)]
+
+    def clear(self):
+        if self.spilled:
+            self.store.delete(self.chat_id)
+        self.spilled = 0
+        self.recent.clear()
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split the text into lowercase words.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        list: The words of the text.
+    """
+    return re.findall(r"\w+", text.lower())
+
+
+def chunk_document(document: str) -> List[str]:
+    """
+    Split a document into overlapping chunks of words. The header of the
+    document, the part before the first empty lines, is repeated at the
+    start of every chunk, so each chunk still says what it is about.
+
+    Args:
+        document (str): The document to split.
+
+    Returns:
+        list: The chunks of the document.
+    """
+    header, _, body = document.partition("\n\n\n")
+    words = body.split()
+    if not words:
+        return [document]
+    step = LOCAL_CHUNK_WORDS - LOCAL_CHUNK_OVERLAP_WORDS
+    return [
+        f"{header}\n{' '.join(words[i : i + LOCAL_CHUNK_WORDS])}"
+        for i in range(0, max(1, len(words) - LOCAL_CHUNK_OVERLAP_WORDS), step)
+    ]
+
+
+def bm25_weights(term_frequencies: np.ndarray) -> np.ndarray:
+    """
+    Compute the BM25 weight of every term in every chunk.
+
+    Args:
+        term_frequencies (np.ndarray): The number of occurrences
+            of every term (columns) in every chunk (rows).
+
+    Returns:
+        np.ndarray: The BM25 weights, in the same shape.
+    """
+    chunk_lengths = term_frequencies.sum(axis=1, keepdims=True)
+    document_frequencies = (term_frequencies > 0).sum(axis=0)
+    idf = np.log(
+        1 + (len(term_frequencies) - document_frequencies + 0.5) / (document_frequencies + 0.5)
+    )
+    length_norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk_lengths / max(chunk_lengths.mean(), 1))
+    weights = idf * term_frequencies * (BM25_K1 + 1) / (term_frequencies + length_norm)
+    return weights.astype(np.float32)
+
+
+class LocalIndex:
+    """
+    In-memory BM25 index over chunks of documents. The BM25 weight of
+    every term in every chunk is precomputed into a NumPy matrix, so
+    a query is scored with a single sum over the columns of its terms.
+    The matrix is saved to disk and memory-mapped when loaded again.
+    """
+
+    def __init__(self, chunks: List[str], vocabulary: dict, weights: np.ndarray):
+        self.chunks = chunks
+        self.vocabulary = vocabulary
+        self.weights = weights
+
+    @classmethod
+    def build(cls, documents: List[str]) -> "LocalIndex":
+        chunks = [chunk for document in documents for chunk in chunk_document(document)]
+        chunk_terms = [tokenize(chunk) for chunk in chunks]
+        vocabulary = {}
+        for terms in chunk_terms:
+            for term in terms:
+                vocabulary.setdefault(term, len(vocabulary))
+
+        term_frequencies = np.zeros((len(chunks), len(vocabulary)), dtype=np.float32)
+        for i, terms in enumerate(chunk_terms):
+            for term in terms:
+                term_frequencies[i, vocabulary[term]] += 1
+
+        return cls(chunks, vocabulary, bm25_weights(term_frequencies))
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump({"chunks": self.chunks, "vocabulary": self.vocabulary}, f)
+        weights_file = os.path.join(directory, "weights.npy")
+        with open(f"{weights_file}.tmp", "wb") as f:
+            np.save(f, self.weights)
+        os.replace(f"{weights_file}.tmp", weights_file)
+
+    @classmethod
+    def load(cls, directory: str) -> "LocalIndex":
+        with open(os.path.join(directory, "chunks.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        weights = np.load(os.path.join(directory, "weights.npy"), mmap_mode="r")
+        return cls(data["chunks"], data["vocabulary"], weights)
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        terms = sorted({self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary})
+        if not terms:
+            return []
+        scores = np.asarray(self.weights[:, terms].sum(axis=1))
+        ranking = np.argsort(-scores, kind="stable")[:limit]
+        return [(self.chunks[i], float(scores[i])) for i in ranking if scores[i] > 0]
+
+
+class TurnTrace:
+    """
+    Timed spans of the pipeline stages of a single chat turn.
+    Spans can be added from several threads.
+    """
+
+    def __init__(self, turn_id: Optional[str] = None):
+        self.turn_id = turn_id or uuid.uuid4().hex
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span: dict):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_record(self) -> dict:
+        return {
+            "turn_id": self.turn_id,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "spans": sorted(self.spans, key=lambda span: span["start_ms"]),
+        }
+
+
+class StageTimings:
+    """
+    Recent wall times of the pipeline stages, shared by all chats, to estimate
+    how long a stage will take. Times older than `max_age_seconds` are dropped,
+    so a stage skipped for being slow is run, and timed, again once they expire.
+    """
+
+    def __init__(
+        self,
+        window: int = STAGE_TIMING_WINDOW,
+        max_age_seconds: float = STAGE_TIMING_MAX_AGE_SECONDS,
+    ):
+        self.window = window
+        self.max_age_seconds = max_age_seconds
+        self._seconds = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            times = self._seconds.setdefault(stage, deque(maxlen=self.window))
+            times.append((time.monotonic(), seconds))
+
+    def record(self, trace: TurnTrace):
+        for span in trace.spans:
+            if "duration_ms" in span:
+                self.add(span["stage"], span["duration_ms"] / 1000)
+
+    def estimate(
+        self, stage: str, percentile: int = STAGE_TIMING_PERCENTILE, min_count: int = 1
+    ) -> float:
+        """
+        Estimate the wall time of a stage from its recent times.
+
+        Args:
+            stage (str): The name of the pipeline stage.
+            percentile (int): The percentile of the recent times to use.
+            min_count (int): The number of recent times needed for an estimate.
+
+        Returns:
+            float: The percentile of the recent times of the stage in seconds,
+                0 if it was run fewer than `min_count` times recently.
+        """
+        now = time.monotonic()
+        with self._lock:
+            times = sorted(
+                seconds
+                for timestamp, seconds in self._seconds.get(stage, ())
+                if now - timestamp <= self.max_age_seconds
+            )
+        if len(times) < max(1, min_count):
+            return 0
+        return times[min(len(times) - 1, len(times) * percentile // 100)]
+
+
+@dataclass(frozen=True)
+class PipelineSettings:
+    """
+    Options of the answer pipeline. The names of the options are the keys
+    of the matching widgets in the sidebar of the Streamlit application.
+    """
+
+    selected_cortex_search_service: Optional[str] = None
+    search_all_services: bool = False
+    debug: bool = False
+    use_chat_history: bool = True
+    run_in_parallel: bool = True
+    stream_answer: bool = True
+    incremental_chat_summary: bool = True
+    speculative_retrieval: bool = True
+    latency_budget_seconds: float = 0.0
+    answer_pipeline: str = ANSWER_PIPELINES[0]
+    retrieval_backend: str = RETRIEVAL_BACKENDS[0]
+    trace_sink: str = TRACE_SINKS[0]
+    use_completion_cache: bool = True
+    completion_cache_ttl_minutes: int = 60
+    completion_deadline_seconds: int = 30
+    completion_max_wait_seconds: int = 120
+    hedge_slow_calls: bool = True
+    hedge_delay_seconds: float = 10.0
+    model_fallback: bool = True
+    model_name__generic: str = MODELS[0]
+    model_name__service: str = MODELS[0]
+    model_name__aggregation: str = MODELS[1]
+    model_name__summary: str = MODELS[1]
+    model_name__router: str = MODELS[2]
+    num_retrieved_chunks: int = 50
+    rerank_chunks: bool = True
+    num_reranked_chunks: int = 5
+    context_token_budget: int = 4000
+    num_chat_messages: int = 20
+    max_chat_message_chars: int = 2000
+
+    @classmethod
+    def from_mapping(cls, options: Mapping) -> "PipelineSettings":
+        return cls(**{f.name: options[f.name] for f in fields(cls) if f.name in options})
+
+
+@dataclass(frozen=True)
+class ChatSummary:
+    """
+    Running summary of a chat, covering its first `message_count` messages,
+    computed for a chat history window of `window` messages.
+    """
+
+    summary: str = ""
+    message_count: int = 0
+    window: Optional[int] = None
+
+
+class Job:
+    """
+    A question submitted to the engine, answered in a background thread.
+    The answer grows chunk by chunk while it is generated, and can be read
+    from any thread, like a Streamlit script run polling for it.
+    Debug notes, like the retrieved context, are collected in `notes`.
+    The trace is complete once the job is finished and, if the caller
+    renders the answer, once the caller marks the answer as rendered.
+    `on_trace_complete` is then called with the job.
+    """
+
+    def __init__(
+        self,
+        question: str,
+        messages: List[dict],
+        settings: PipelineSettings,
+        chat_summary: ChatSummary,
+        previous_job_id: Optional[str],
+        first_message_position: int,
+        render: bool = False,
+    ):
+        self.job_id = uuid.uuid4().hex
+        self.question = question
+        self.messages = messages
+        self.first_message_position = first_message_position
+        self.settings = settings
+        self.chat_summary = chat_summary
+        self.previous_job_id = previous_job_id
+        self.trace = TurnTrace(self.job_id)
+        self.notes = {}
+        self.skipped_stages = []
+        self.status = "queued"
+        self.chunks = []
+        self.answer = None
+        self.error = None
+        self.render = render
+        self.rendered = False
+        self.on_trace_complete = None
+        self._trace_parts = {"pipeline", "render"} if render else {"pipeline"}
+        self._render_timer = None
+        self._condition = threading.Condition()
+
+    def write(self, chunk: str):
+        with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+
+    def set_answer(self, answer: str):
+        with self._condition:
+            self.answer = answer
+            self.status = "answered"
+            self._condition.notify_all()
+
+    def set_done(self, error: Optional[BaseException] = None):
+        with self._condition:
+            self.error = error
+            self.status = "done" if error is None else "failed"
+            self._condition.notify_all()
+
+    def set_rendered(self):
+        with self._condition:
+            self.rendered = True
+            timer = self._render_timer
+            self._condition.notify_all()
+        if timer is not None:
+            timer.cancel()
+        self.finish_trace("render")
+
+    def expect_render_within(self, seconds: float):
+        """
+        Complete the trace without the render of the answer if the caller
+        does not mark it as rendered within the given time, like when the
+        chat is cleared or closed first. No thread of the engine waits meanwhile.
+
+        Args:
+            seconds (float): The maximum number of seconds to wait for the render.
+        """
+        timer = threading.Timer(seconds, self.finish_trace, ("render",))
+        timer.daemon = True
+        with self._condition:
+            if self.rendered:
+                return
+            self._render_timer = timer
+        timer.start()
+
+    def finish_trace(self, part: str):
+        """
+        Mark a part of the trace as complete: "pipeline" once the job is
+        finished, "render" once the answer is rendered. Once all the parts
+        are complete, call `on_trace_complete` with the job, only once.
+
+        Args:
+            part (str): The part of the trace.
+        """
+        with self._condition:
+            if part not in self._trace_parts:
+                return
+            self._trace_parts.remove(part)
+            complete = not self._trace_parts
+        if complete and self.on_trace_complete is not None:
+            self.on_trace_complete(self)
+
+    def wait_for_answer(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the first chunk of the answer is available,
+        or the job is finished.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait, or None to wait forever.
+
+        Returns:
+            bool: True if the answer started, False if the wait timed out.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.chunks or self.status in ["answered", "done", "failed"], timeout
+            )
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the job is finished, including the work done
+        after the answer, like updating the running chat summary.
+
+        Args:
+            timeout (float): The maximum number of seconds to wait, or None to wait forever.
+
+        Returns:
+            bool: True if the job is finished, False if the wait timed out.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.status in ["done", "failed"], timeout)
+
+    def stream(self) -> Iterator[str]:
+        """
+        Yield the chunks of the answer, from the first one, as soon as they
+        are generated. Raise the error of the job if it failed before the
+        answer was complete.
+
+        Yields:
+            str: The next chunk of the answer.
+        """
+        position = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: len(self.chunks) > position
+                    or self.answer is not None
+                    or self.error is not None
+                )
+                chunks = self.chunks[position:]
+                answered = self.answer is not None
+            if chunks:
+                position += len(chunks)
+                yield from chunks
+            elif answered:
+                return
+            else:
+                raise self.error
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+current_job = contextvars.ContextVar("current_job", default=None)
+trace_file_lock = threading.Lock()
+
+
+def run_concurrently(*tasks: Callable):
+    """
+    Run the given tasks in separate threads and wait for all of them.
+    Every task runs in a copy of the current context, so its stages
+    are recorded in the trace of the current chat turn.
+
+    Args:
+        *tasks (Callable): Functions without arguments to run.
+
+    Returns:
+        list: Results of the tasks, in the same order as the tasks.
+    """
+    with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+@contextmanager
+def trace_stage(stage: str, **attributes):
+    """
+    Record the wall time of a pipeline stage, with the given attributes,
+    in the trace of the current chat turn. Functions called within the
+    stage can add attributes to its span with `annotate_span`.
+
+    Args:
+        stage (str): The name of the pipeline stage.
+        **attributes: Attributes of the span, like the name of a model.
+
+    Yields:
+        dict: The span of the stage.
+    """
+    trace = current_trace.get()
+    span = {"stage": stage, **attributes}
+    token = current_span.set(span)
+    started_at = time.perf_counter()
+    try:
+        yield span
+    finally:
+        finished_at = time.perf_counter()
+        current_span.reset(token)
+        if trace is not None:
+            span["start_ms"] = round(1000 * (started_at - trace.started_at), 1)
+            span["end_ms"] = round(1000 * (finished_at - trace.started_at), 1)
+            span["duration_ms"] = round(1000 * (finished_at - started_at), 1)
+            trace.add(span)
+
+
+def annotate_span(**attributes):
+    """
+    Add the given attributes to the span of the current pipeline stage.
+
+    Args:
+        **attributes: Attributes of the span, like token counts.
+    """
+    span = current_span.get()
+    if span is not None:
+        span.update(attributes)
+
+
+def write_trace(trace: TurnTrace, trace_sink: str):
+    """
+    Write the trace of a chat turn to the given sink: the event table,
+    through the logging module, or a JSONL file.
+
+    Args:
+        trace (TurnTrace): The trace of the chat turn.
+        trace_sink (str): One of the sinks from `TRACE_SINKS`.
+    """
+    if trace_sink == "Event table":
+        logger.info(json.dumps(trace.to_record()))
+    elif trace_sink == "JSONL file":
+        with trace_file_lock, open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(trace.to_record()) + "\n")
+
+
+def add_note(name: str, value):
+    """
+    Add a debug note, like the retrieved context, to the current job.
+
+    Args:
+        name (str): The name of the note.
+        value: The content of the note.
+    """
+    job = current_job.get()
+    if job is not None:
+        job.notes[name] = value
+
+
+def parse_target_lag(target_lag: str) -> float:
+    """
+    Convert the target lag of a cortex search service, like '1 hour'
+    or '5 minutes', to seconds. Fall back to one hour for lags that
+    cannot be parsed, like 'DOWNSTREAM'.
+
+    Args:
+        target_lag (str): The target lag of the service.
+
+    Returns:
+        float: The target lag in seconds.
+    """
+    match = re.fullmatch(
+        r"\s*(\d+)\s*(second|minute|hour|day)s?\s*", str(target_lag or ""), re.IGNORECASE
+    )
+    if match is None:
+        return DEFAULT_TARGET_LAG_SECONDS
+    unit_seconds = {"second": 1, "minute": 60, "hour": 60 * 60, "day": 24 * 60 * 60}
+    return int(match.group(1)) * unit_seconds[match.group(2).lower()]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in the given text.
+
+    Args:
+        text (str): The text to estimate the number of tokens of.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def fallback_models(model: str, prompt: str) -> List[str]:
+    """
+    List the models to try, in order, for a prompt: the given model, then
+    its faster fallback models from `FALLBACK_MODELS` whose context window
+    fits the prompt.
+
+    Args:
+        model (str): The model selected for the prompt.
+        prompt (str): The prompt to generate a completion for.
+
+    Returns:
+        list: The names of the models.
+    """
+    prompt_tokens = estimate_tokens(prompt) + PROMPT_RESERVED_TOKENS
+    return [model] + [
+        m for m in FALLBACK_MODELS.get(model, []) if MODEL_CONTEXT_WINDOWS[m] >= prompt_tokens
+    ]
+
+
+def plan_skipped_stages(budget_seconds: float, answer_pipeline: str, estimates: dict) -> List[str]:
+    """
+    Choose the optional stages to skip so that a chat turn fits the latency
+    budget, given the estimated wall times of the stages. Merging a generic
+    answer is given up first, answering with the RAG model alone, then the
+    summary of the chat history, searching with the question alone. Once the
+    summary is skipped, the merge is kept if the shorter RAG stage leaves it
+    enough time. If nothing fits, every optional stage is skipped.
+
+    Args:
+        budget_seconds (float): The time left for the turn.
+        answer_pipeline (str): One of the pipelines from `ANSWER_PIPELINES`.
+        estimates (dict): The estimated seconds of every stage. The RAG stage
+            includes the summary and the search.
+
+    Returns:
+        list: The names of the stages to skip.
+    """
+    router = estimates["router"] if answer_pipeline == "Route with classifier" else 0
+    merges = answer_pipeline != "Route on RAG answer"
+    rag_without_summary = max(0, estimates["rag"] - estimates["summary"])
+
+    plans = []
+    for skipped_summary, rag in [([], estimates["rag"]), (["summary"], rag_without_summary)]:
+        if merges:
+            merged = router + max(rag, estimates["generic"]) + estimates["aggregation"]
+            plans.append((skipped_summary, merged))
+            plans.append((["generic", "aggregation"] + skipped_summary, router + rag))
+        else:
+            plans.append((skipped_summary, router + rag))
+    for skipped, seconds in plans:
+        if seconds <= budget_seconds:
+            return skipped
+    return plans[-1][0]
+
+
+def pack_context(documents: List[str], model: str, token_budget: int) -> str:
+    """
+    Assemble the context documents, in rank order, into a single string
+    that fits the token budget and the context window of the model.
+    Documents that are near duplicates of an already packed document
+    are skipped. If not even the first document fits, it is truncated.
+
+    Args:
+        documents (list): The context documents ordered by relevance.
+        model (str): The name of the model the context is sent to.
+        token_budget (int): The maximum number of tokens of the context.
+
+    Returns:
+        str: The concatenated string of context documents.
+    """
+    token_budget = min(token_budget, MODEL_CONTEXT_WINDOWS[model] - PROMPT_RESERVED_TOKENS)
+
+    parts = []
+    packed_words = []
+    used_tokens = 0
+    for document in documents:
+        words = set(document.lower().split())
+        if any(len(words & w) >= NEAR_DUPLICATE_SIMILARITY * len(words | w) for w in packed_words):
+            continue
+
+        part = f"Context document {len(parts) + 1}: {document} \n\n"
+        part_tokens = estimate_tokens(part)
+        if used_tokens + part_tokens > token_budget:
+            if not parts:
+                parts.append(part[: token_budget * CHARS_PER_TOKEN])
+            break
+
+        parts.append(part)
+        packed_words.append(words)
+        used_tokens += part_tokens
+
+    return "".join(parts)
+
+
+def find_episode_number(question: str) -> Optional[int]:
+    """
+    Find the number of the episode the question is about, if it names one,
+    like "episode 3" or "the third episode".
+
+    Args:
+        question (str): The user's question.
+
+    Returns:
+        int: The episode number, or None if the question names no episode.
+    """
+    match = re.search(r"\b(?:episode|eposode|ep\.?)\s*(\d+)\b", question, re.IGNORECASE)
+    if match:
+        return int(match.group(1))
+    match = re.search(
+        rf"\b({'|'.join(EPISODE_ORDINALS)})\s+(?:episode|eposode)\b", question, re.IGNORECASE
+    )
+    if match:
+        return EPISODE_ORDINALS.index(match.group(1).lower()) + 1
+    return None
+
+
+def match_attributes(question: str, results: List[dict]) -> List[bool]:
+    """
+    Find the search results matching the episode number (NO attribute)
+    or a character named in the question (the part of the WHO attribute
+    after " as "). Only names that identify at most two results are used.
+    Words of titles can still match, like "Jedi", which is part of the
+    characters of Sol and Yoda, so matching results are only boosted
+    when reranking, and the others are never dropped.
+
+    Args:
+        question (str): The user's question.
+        results (list): The search results, with their attribute columns.
+
+    Returns:
+        list: Whether every search result matches, in the same order.
+    """
+    episode = find_episode_number(question)
+    matches = [
+        episode is not None and "NO" in r and str(r["NO"]).strip() == str(episode) for r in results
+    ]
+
+    question_terms = set(tokenize(question))
+    result_names = []
+    for r in results:
+        who = str(r.get("WHO", ""))
+        character = who.partition(" as ")[2] or who
+        result_names.append(
+            {t for name in re.findall(r"[A-Z][\w-]+", character) for t in tokenize(name)}
+        )
+    name_counts = Counter(name for names in result_names for name in names)
+    named = {name for name in question_terms if 0 < name_counts[name] <= 2}
+    return [match or bool(names & named) for match, names in zip(matches, result_names)]
+
+
+def rerank(query: str, documents: List[str], boosts: Optional[List[float]] = None) -> List[int]:
+    """
+    Rerank the documents returned by the search service, blending their
+    original rank with a BM25 score of the query computed over them,
+    and adding the given boosts.
+
+    Args:
+        query (str): The query the documents were retrieved with.
+        documents (list): The documents in their original order.
+        boosts (list): The score to add to every document, if any.
+
+    Returns:
+        list: The positions of the documents, from the most relevant.
+    """
+    query_terms = sorted(set(tokenize(query)))
+    if not documents:
+        return []
+
+    term_frequencies = np.zeros((len(documents), len(query_terms)), dtype=np.float32)
+    for i, document in enumerate(documents):
+        document_terms = Counter(tokenize(document))
+        term_frequencies[i] = [document_terms[t] for t in query_terms]
+    # The lengths of the documents are needed for BM25, so add a column with
+    # the number of all the other terms of every document.
+    other_terms = np.array(
+        [len(tokenize(d)) for d in documents], dtype=np.float32
+    ) - term_frequencies.sum(axis=1)
+    lexical_scores = bm25_weights(np.column_stack([term_frequencies, other_terms]))[
+        :, : len(query_terms)
+    ].sum(axis=1)
+
+    if lexical_scores.max() > 0:
+        lexical_scores = lexical_scores / lexical_scores.max()
+    rank_scores = 1 - np.arange(len(documents)) / len(documents)
+    scores = RERANK_LEXICAL_WEIGHT * lexical_scores + (1 - RERANK_LEXICAL_WEIGHT) * rank_scores
+    if boosts is not None:
+        scores = scores + np.asarray(boosts, dtype=np.float32)
+    return [int(i) for i in np.argsort(-scores, kind="stable")]
+
+
+def load_local_documents(sessions: "SessionPool") -> List[str]:
+    """
+    Load the documents of the local index: the listing text of every
+    episode and cast member. Build it from the TSV files in the `data`
+    directory if it is deployed next to the application, otherwise
+    query it from the source tables of the cortex search services.
+
+    Args:
+        sessions (SessionPool): The pool of sessions to query the source tables with.
+
+    Returns:
+        list: The listing text of every episode and cast member.
+    """
+    if not os.path.isdir(LOCAL_DATA_DIR):
+        with sessions.checkout() as session:
+            return [row[0] for query in LOCAL_INDEX_QUERIES for row in session.sql(query).collect()]
+
+    episodes_file, actors_file = LOCAL_DATA_FILES
+    with open(os.path.join(LOCAL_DATA_DIR, episodes_file), encoding="utf-8") as f:
+        documents = [
+            f"The Acolyte, eposode {r['no']}, directed by {r['directed_by']}, "
+            f"written by {r['written_by']}, released on {r['original_release_date']}"
+            f"\n\n\nPlot: \n{r['plot']}"
+            for r in csv.DictReader(f, delimiter="\t")
+        ]
+    with open(os.path.join(LOCAL_DATA_DIR, actors_file), encoding="utf-8") as f:
+        documents += [
+            f"Actor and character they played: {r['who']}"
+            f"\n\n\nHistory of the engagement: \n{r['history']}"
+            for r in csv.DictReader(f, delimiter="\t")
+        ]
+    return documents
+
+
+def describe_local_sources(sessions: "SessionPool") -> dict:
+    """
+    Describe the sources of the documents of the local index without
+    reading them: the size and modification time of the TSV files in the
+    `data` directory if it is deployed next to the application, otherwise
+    the row count and the time of the last change of the source tables.
+    The chunking options are included, as they also shape the index.
+
+    Args:
+        sessions (SessionPool): The pool of sessions to query the source tables with.
+
+    Returns:
+        dict: The description of the sources, that changes whenever the documents change.
+    """
+    if os.path.isdir(LOCAL_DATA_DIR):
+        sources = {}
+        for name in LOCAL_DATA_FILES:
+            stat = os.stat(os.path.join(LOCAL_DATA_DIR, name))
+            sources[name] = [stat.st_size, stat.st_mtime_ns]
+    else:
+        with sessions.checkout() as session:
+            rows = session.sql(LOCAL_SOURCE_TABLES_QUERY).collect()
+        sources = {row[0]: [row[1], str(row[2])] for row in rows}
+    return {
+        "sources": sources,
+        "chunk_words": LOCAL_CHUNK_WORDS,
+        "chunk_overlap_words": LOCAL_CHUNK_OVERLAP_WORDS,
+    }
+
+
+def fuse_results(result_lists: List[List[dict]]) -> List[dict]:
+    """
+    Merge the search results of several services with reciprocal rank
+    fusion. Results with the same text are merged, adding up their scores.
+
+    Args:
+        result_lists (list): The search results of every service,
+            each ordered by relevance.
+
+    Returns:
+        list: The merged search results ordered by relevance.
+    """
+    scores = {}
+    fused = {}
+    for results in result_lists:
+        for rank, result in enumerate(results):
+            key = " ".join(result["text"].lower().split())
+            scores[key] = scores.get(key, 0) + 1 / (RECIPROCAL_RANK_FUSION_K + rank + 1)
+            fused.setdefault(key, result)
+    return [fused[key] for key in sorted(fused, key=lambda key: -scores[key])]
+
+
+def get_chat_history(messages: List[dict], num_chat_messages: int) -> List[dict]:
+    """
+    Retrieve the chat history preceding the last message, limited
+    to the given number of messages.
+
+    Args:
+        messages (list): The chat messages, the last one being the current question.
+        num_chat_messages (int): The maximum number of messages to use.
+
+    Returns:
+        list: The list of chat messages.
+    """
+    start_index = max(0, len(messages) - num_chat_messages)
+    return messages[start_index : len(messages) - 1]
+
+
+def format_chat_history(messages: List[dict], max_chars: int) -> str:
+    """
+    Render chat messages as a compact transcript to use in prompts,
+    one message per line prefixed with its role. Messages longer
+    than the given limit are truncated.
+
+    Args:
+        messages (list): The chat messages to render.
+        max_chars (int): The maximum number of characters per message.
+
+    Returns:
+        str: The transcript of the chat messages.
+    """
+    lines = []
+    for message in messages:
+        content = " ".join(message["content"].split())
+        if len(content) > max_chars:
+            content = content[:max_chars].rstrip() + "..."
+        lines.append(f"{message['role'].capitalize()}: {content}")
+    return "\n".join(lines)
+
+
+def create_chat_history_summary_prompt(chat_history: str, question: str) -> str:
+    """
+    Create a prompt for the language model to extend the current
+    question with the chat history, into a query for the search.
+
+    Args:
+        chat_history (str): The chat history to include in the summary.
+        question (str): The current user question to extend with the chat history.
+
+    Returns:
+        str: The generated prompt for the language model.
+    """
+    prompt = dedent(
+        f"""
+        Based on the chat history below and the question, generate
+        a query that extend the question with the chat history provided.
+        The query should be in natural language.
+        Answer with only the query. Do not add any explanation.
+
+        <chat_history>
+        {chat_history}
+        </chat_history>
+        <question>
+        {question}
+        </question>
+    """
+    )
+
+    return prompt
+
+
+def create_chat_summary_fold_prompt(chat_summary: str, new_messages: str) -> str:
+    """
+    Create a prompt for the language model to extend the running
+    summary of the chat with the newest messages.
+
+    Args:
+        chat_summary (str): The summary of the chat so far, can be empty.
+        new_messages (str): The chat messages not covered by the summary yet.
+
+    Returns:
+        str: The generated prompt for the language model.
+    """
+    prompt = dedent(
+        f"""
+        Based on the summary of a chat and the newest messages of the chat
+        below, generate a new summary that covers both of them.
+        Keep the names, episodes and facts that following questions may refer to.
+        Answer with only the summary. Do not add any explanation.
+
+        <chat_summary>
+        {chat_summary}
+        </chat_summary>
+        <new_messages>
+        {new_messages}
+        </new_messages>
+    """
+    )
+
+    return prompt
+
+
+def create_specialized_prompt(user_question: str, chat_history: str, prompt_context: str) -> str:
+    """
+    Create a prompt for the language model by combining the user question
+    with context retrieved from the cortex search service
+    and chat history (if enabled). Format the prompt according to
+    the expected input format of the model.
+
+    Args:
+        user_question (str): The user's question to generate a prompt for.
+        chat_history (str): The chat history transcript, empty if not used.
+        prompt_context (str): The context documents retrieved for the question.
+
+    Returns:
+        str: The generated prompt for the language model.
+    """
+    prompt = dedent(
+        f"""
+        You are a helpful AI chat assistant with RAG capabilities.
+
+        Use chat history provided between <chat_history>
+        and </chat_history> tags.
+        Question is between <question> and </question> tags.
+        The context is between <context> and </context> tags.
+
+        You will be working with data from wikipedia.
+        The data contains plot of a series 'The Acolyte'.
+
+        Don't saying things like "according to the provided context".
+        If you don't know the answer just say: "I do not know the answer".
+
+
+        <chat_history>
+        {chat_history}
+        </chat_history>
+        <context>
+        {prompt_context}
+        </context>
+        <question>
+        {user_question}
+        </question>
+
+        Answer:
+        """
+    )
+    return prompt
+
+
+def create_generic_prompt(user_question: str, chat_history: str):
+    """
+    Create a prompt for the language model using chat history (if enabled).
+    Format the prompt according to the expected input format of the model.
+    Don't use any additional context.
+
+    Args:
+        user_question (str): The user's question to generate a prompt for.
+        chat_history (str): The chat history transcript, empty if not used.
+
+    Returns:
+        str: The generated prompt for the language model.
+    """
+
+    prompt = dedent(
+        f"""
+        You are a helpful AI chat assistant.
+
+        Use chat history provided between <chat_history>
+        and </chat_history> tags.
+        Question is between <question> and </question> tags.
+
+        If you don't know the answer just say: "I do not know the answer".
+
+
+        <chat_history>
+        {chat_history}
+        </chat_history>
+        <question>
+        {user_question}
+        </question>
+
+        Answer:
+        """
+    )
+    return prompt
+
+
+def create_aggregation_prompt(user_question: str, answer_a: str, answer_b: str, chat_history: str):
+    """
+    Create a prompt for the language model to combine two answers
+    provided as an input. It is also using question that was asked
+    and chat history (if enabled). Format the prompt according to
+    the expected input format of the model.
+
+    Args:
+        user_question (str): The user's question to generate a prompt for.
+        answer_a (str): First answer to evaluate and merge.
+        answer_b (str): Second answer to evaluate and merge.
+        chat_history (str): The chat history transcript, empty if not used.
+
+    Returns:
+        str: The generated prompt for the language model.
+    """
+
+    prompt = dedent(
+        f"""
+        You are a helpful AI chat assistant.
+        You are evaluating two answers to a question provided
+        between <question> and </question> tags.
+
+        Provided answers can be found
+        between <answer_a> and </answer_a> for the first answer,
+        and <answer_b> and </answer_b> for second answer.
+
+        Use history of the chat so far that is provided
+        between <chat_history> and </chat_history> tags.
+
+        Merge both answers into one, and return it.
+        Ignore the answer that means "I don't know".
+
+        Don't saying things like "according to the provided context".
+
+        <chat_history>
+        {chat_history}
+        </chat_history>
+        <answer_a>
+        {answer_a}
+        </answer_a>
+        <answer_b>
+        {answer_b}
+        </answer_b>
+        <question>
+        {user_question}
+        </question>
+
+        Answer:
+        """
+    )
+    return prompt
+
+
+def create_router_prompt(user_question: str, chat_history: str) -> str:
+    """
+    Create a prompt for a small language model to decide which answers
+    are needed for the user question: an answer based on the data of
+    the series, a generic answer, or both of them merged.
+
+    Args:
+        user_question (str): The user's question to classify.
+        chat_history (str): The chat history transcript, empty if not used.
+
+    Returns:
+        str: The generated prompt for the language model.
+    """
+    prompt = dedent(
+        f"""
+        You are routing questions of a chat about the series 'The Acolyte'.
+        Question is between <question> and </question> tags.
+        Use chat history provided between <chat_history>
+        and </chat_history> tags.
+
+        Answer with SERIES if the question is about the plot, episodes,
+        characters or cast of 'The Acolyte'.
+        Answer with GENERIC if the question does not need any information
+        about 'The Acolyte'.
+        Answer with BOTH if the question needs both.
+        Answer with only one word. Do not add any explanation.
+
+        <chat_history>
+        {chat_history}
+        </chat_history>
+        <question>
+        {user_question}
+        </question>
+    """
+    )
+
+    return prompt
+
+
+def parse_route(response: str) -> str:
+    """
+    Read the route chosen by the language model for the user question.
+
+    Args:
+        response (str): The answer of the model to the router prompt.
+
+    Returns:
+        str: One of "series", "generic" or "both".
+    """
+    route = response.strip().upper()
+    for label in ["SERIES", "GENERIC"]:
+        if route.startswith(label):
+            return label.lower()
+    return "both"
+
+
+def is_unknown_answer(answer: str) -> bool:
+    """
+    Check if the answer only says that the model does not know the answer.
+
+    Args:
+        answer (str): The answer of the model.
+
+    Returns:
+        bool: True if the answer means "I don't know".
+    """
+    return len(answer) <= UNKNOWN_ANSWER_MAX_CHARS and (
+        re.search(r"\bI (do not|don't|don’t) know\b", answer, re.IGNORECASE) is not None
+    )
+
+
+class CompletionRequest:
+    """
+    A request of a completion, racing other requests for the same prompt.
+    Cancelling it stops a streamed answer at its next chunk, and cancels
+    the query of an answer that is not streamed, freeing its session.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.cancelled = threading.Event()
+        self._query = None
+        self._lock = threading.Lock()
+
+    def attach(self, query):
+        with self._lock:
+            self._query = query
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            query.cancel()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled.set()
+            query = self._query
+        if query is not None:
+            query.cancel()
+
+
+class Engine:
+    """
+    Answers the questions of the chat with Cortex Search and the Cortex
+    LLM functions. Questions are submitted as jobs and answered by a pool
+    of background threads, and every call to Snowflake draws a session from
+    the session pool. The caches, the local index and the registry of cortex
+    search services are created once and shared by all jobs.
+    """
+
+    def __init__(
+        self,
+        sessions: SessionPool,
+        max_workers: int = JOB_WORKERS,
+        completion_cache_backend: str = COMPLETION_CACHE_BACKENDS[0],
+        completion_cache_size: int = COMPLETION_CACHE_SIZE,
+    ):
+        self.sessions = sessions
+        self.completion_cache_backend = completion_cache_backend
+        self.completion_cache_size = completion_cache_size
+        self.jobs = TTLCache(JOB_HISTORY_SIZE, JOB_TTL_SECONDS)
+        # Jobs whose trace is not complete yet, kept out of reach of the
+        # eviction of `jobs` until they are finished and rendered.
+        self._active_jobs = {}
+        self._active_jobs_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="acolyte-job")
+        self._completion_executor = ThreadPoolExecutor(
+            COMPLETION_WORKERS, thread_name_prefix="acolyte-completion"
+        )
+        # Cancellations get their own threads, so they are never queued
+        # behind the completions waiting for the sessions they would free.
+        self._cancel_executor = ThreadPoolExecutor(
+            CANCEL_WORKERS, thread_name_prefix="acolyte-cancel"
+        )
+        self._service_metadata = TTLCache(1, SERVICE_METADATA_REFRESH_SECONDS)
+        self.stage_timings = StageTimings()
+        self.single_flight = SingleFlight()
+        self._resources = {}
+        self._resources_lock = threading.Lock()
+        sessions.on_close(self.forget_session)
+
+    def submit(
+        self,
+        question: str,
+        messages: List[dict],
+        settings: PipelineSettings,
+        chat_summary: ChatSummary = ChatSummary(),
+        previous_job_id: Optional[str] = None,
+        first_message_position: int = 0,
+        render: bool = False,
+    ) -> str:
+        """
+        Start answering the question in the background.
+
+        Args:
+            question (str): The user's question.
+            messages (list): The latest chat messages, the last one being the question.
+                They must include the chat history window and the messages not
+                covered by the running summary of the chat yet.
+            settings (PipelineSettings): The options of the answer pipeline.
+            chat_summary (ChatSummary): The running summary of the chat.
+            previous_job_id (str): The job of the previous question of the chat, if any.
+                Its running summary of the chat is used once it is finished.
+            first_message_position (int): The position of the first of the
+                messages in the chat, if older messages are left out.
+            render (bool): Whether the caller renders the answer, adding a "render"
+                span to the trace of the job, and marks the job as rendered then.
+                The trace is only written once the span is added, or
+                `RENDER_WAIT_SECONDS` after the job is finished if the
+                answer is never rendered.
+
+        Returns:
+            str: The ID of the job answering the question.
+        """
+        job = Job(
+            question,
+            list(messages),
+            settings,
+            chat_summary,
+            previous_job_id,
+            first_message_position,
+            render,
+        )
+        job.on_trace_complete = self.complete_job
+        with self._active_jobs_lock:
+            self._active_jobs[job.job_id] = job
+        self.jobs.put(job.job_id, job)
+        self._executor.submit(contextvars.Context().run, self._run, job)
+        return job.job_id
+
+    def job(self, job_id: Optional[str]) -> Optional[Job]:
+        """
+        Look up a job that is not finished or rendered yet,
+        or was submitted in the last `JOB_TTL_SECONDS`.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            Job: The job, or None if it is unknown or expired.
+        """
+        if job_id is None:
+            return None
+        with self._active_jobs_lock:
+            job = self._active_jobs.get(job_id)
+        return job or self.jobs.get(job_id)
+
+    def _run(self, job: Job):
+        current_job.set(job)
+        current_trace.set(job.trace)
+        job.status = "running"
+        try:
+            self.answer(job)
+        except Exception as error:
+            job.set_done(error)
+        else:
+            job.set_done()
+        if job.render:
+            job.expect_render_within(RENDER_WAIT_SECONDS)
+        job.finish_trace("pipeline")
+
+    def complete_job(self, job: Job):
+        """
+        Record the complete trace of the job, and leave it to the history
+        of jobs, from which it is evicted after `JOB_TTL_SECONDS`, or when
+        `JOB_HISTORY_SIZE` more recent jobs are kept.
+
+        Args:
+            job (Job): The finished job.
+        """
+        with self._active_jobs_lock:
+            self._active_jobs.pop(job.job_id, None)
+        self.record_trace(job)
+
+    def record_trace(self, job: Job):
+        """
+        Add the stage times of the complete trace of the job to the recent
+        times of the stages, and write the trace to the sink of the job.
+
+        Args:
+            job (Job): The finished job.
+        """
+        self.stage_timings.record(job.trace)
+        write_trace(job.trace, job.settings.trace_sink)
+
+    def _resource(self, key: Hashable, create: Callable):
+        """
+        Retrieve the shared object with the given key, creating it on first use.
+        The object is created outside of the lock, so creating an object, which
+        may check out a session, never blocks the callers of other objects.
+        Concurrent callers of the same object wait for it to be created.
+
+        Args:
+            key (Hashable): The key of the object.
+            create (Callable): Function without arguments creating the object.
+
+        Returns:
+            The shared object.
+        """
+        with self._resources_lock:
+            future = self._resources.get(key)
+            creating = future is None
+            if creating:
+                future = self._resources[key] = Future()
+        if creating:
+            try:
+                future.set_result(create())
+            except BaseException as error:
+                # Forget the failure, so that the next caller tries again.
+                with self._resources_lock:
+                    del self._resources[key]
+                future.set_exception(error)
+                raise
+        return future.result()
+
+    def forget_session(self, session):
+        """
+        Drop the shared objects bound to a closed session, like the handles
+        of the cortex search services, so that they can be garbage collected.
+
+        Args:
+            session: The closed Snowpark session.
+        """
+        with self._resources_lock:
+            for key in [
+                key
+                for key in self._resources
+                if isinstance(key, tuple) and len(key) > 1 and key[1] is session
+            ]:
+                del self._resources[key]
+
+    def describe_cortex_search_service(self, service: dict) -> dict:
+        """
+        Build the metadata of a cortex search service from its row in the
+        output of SHOW CORTEX SEARCH SERVICES. Only if the row lacks the
+        search column, query it with DESC CORTEX SEARCH SERVICE.
+
+        Args:
+            service (dict): The row describing the service.
+
+        Returns:
+            dict: The name, search column, target lag and attribute columns of the service.
+        """
+        if "search_column" not in service:
+            with self.sessions.checkout() as session:
+                service = (
+                    session.sql(
+                        f"DESC CORTEX SEARCH SERVICE {SERVICE_DB_SCHEMA}.{service['name']};"
+                    )
+                    .collect()[0]
+                    .as_dict()
+                )
+        return {
+            "name": service["name"],
+            "search_column": service["search_column"],
+            "target_lag": service.get("target_lag"),
+            "attribute_columns": service.get("attribute_columns"),
+        }
+
+    def fetch_service_metadata(self) -> List[dict]:
+        """
+        Query the available cortex search services with a single SHOW
+        command, describing services in parallel only when their search
+        column is missing from its output.
+
+        Returns:
+            list: The name, search column, target lag and attribute columns of every service.
+        """
+        with self.sessions.checkout() as session:
+            services = [
+                s.as_dict()
+                for s in session.sql(
+                    f"SHOW CORTEX SEARCH SERVICES IN SCHEMA {SERVICE_DB_SCHEMA};"
+                ).collect()
+            ]
+        if not services:
+            return []
+        return run_concurrently(
+            *[
+                lambda service=service: self.describe_cortex_search_service(service)
+                for service in services
+            ]
+        )
+
+    def service_metadata(self) -> List[dict]:
+        """
+        Retrieve the metadata of the available cortex search services.
+        The metadata is shared by all jobs and refreshed every
+        `SERVICE_METADATA_REFRESH_SECONDS`.
+
+        Returns:
+            list: The name, search column, target lag and attribute columns of every service.
+        """
+        services = self._service_metadata.get(SERVICE_DB_SCHEMA)
+        if services is None:
+            services = self.fetch_service_metadata()
+            self._service_metadata.put(SERVICE_DB_SCHEMA, services)
+        return services
+
+    def service_registry(self) -> dict:
+        """
+        Retrieve the registry of cortex search services. Map every service
+        name to its search column, its target lag in seconds and its
+        attribute columns. A new registry is created whenever the
+        available services change.
+
+        Returns:
+            dict: The service metadata by service name.
+        """
+        service_metadata = tuple(
+            (s["name"], s["search_column"], s["target_lag"], s["attribute_columns"])
+            for s in self.service_metadata()
+        )
+        return self._resource(
+            ("service_registry", service_metadata),
+            lambda: {
+                name: {
+                    "search_column": search_column,
+                    "target_lag_seconds": parse_target_lag(target_lag),
+                    "attribute_columns": [
+                        c.strip().upper() for c in (attribute_columns or "").split(",") if c.strip()
+                    ],
+                }
+                for name, search_column, target_lag, attribute_columns in service_metadata
+            },
+        )
+
+    def search_service(self, session, service_name: str):
+        """
+        Retrieve the handle of a cortex search service bound to the given
+        session, created once per session and service.
+
+        Args:
+            session: The Snowpark session checked out of the session pool.
+            service_name (str): The name of the cortex search service.
+
+        Returns:
+            The ready to use handle of the cortex search service.
+        """
+        root = self._resource(("root", session), lambda: Root(session))
+        return self._resource(
+            ("search_service", session, service_name),
+            lambda: root.databases[SERVICE_DB]
+            .schemas[SERVICE_SCHEMA]
+            .cortex_search_services[service_name],
+        )
+
+    def search_cache(self, service_name: str, ttl_seconds: float) -> TTLCache:
+        """
+        Retrieve the cache of search results for the given cortex search service.
+        Results cannot change faster than the target lag of the service,
+        so it is used as the time to live.
+
+        Args:
+            service_name (str): The name of the cortex search service.
+            ttl_seconds (float): The target lag of the service in seconds.
+
+        Returns:
+            TTLCache: The cache of search results.
+        """
+        return self._resource(
+            ("search_cache", service_name, ttl_seconds),
+            lambda: TTLCache(SEARCH_CACHE_SIZE, ttl_seconds),
+        )
+
+    def completion_cache(self) -> Optional[CompletionCache]:
+        """
+        Retrieve the completion cache shared by all jobs, created on first use
+        with the backend and the size of the engine. Completions are kept for
+        `COMPLETION_CACHE_TTL_SECONDS` at most, and every job only reads the
+        ones younger than the time to live in its settings.
+
+        Returns:
+            CompletionCache: The completion cache, or None if caching is turned off.
+        """
+        if self.completion_cache_backend == "Off":
+            return None
+
+        def create_completion_cache():
+            backends = [TTLCache(self.completion_cache_size, COMPLETION_CACHE_TTL_SECONDS)]
+            if self.completion_cache_backend == "In-process + Snowflake table":
+                backends.append(
+                    SnowflakeTableCache(
+                        self.sessions, COMPLETION_CACHE_TABLE, COMPLETION_CACHE_TTL_SECONDS
+                    )
+                )
+            return CompletionCache(backends)
+
+        return self._resource("completion_cache", create_completion_cache)
+
+    def local_index(self) -> LocalIndex:
+        """
+        Retrieve the local index, created once per process. The index is saved
+        to disk, next to a description of the sources of its documents, and
+        memory-mapped from there on the next start of the application if the
+        sources did not change. Only the description of the sources is read
+        then, not the documents.
+
+        Returns:
+            LocalIndex: The local index over the episodes and cast members.
+        """
+
+        def create_local_index():
+            sources = describe_local_sources(self.sessions)
+            fingerprint = hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()[
+                :16
+            ]
+            directory = os.path.join(LOCAL_INDEX_DIR, fingerprint)
+            sources_file = os.path.join(directory, "sources.json")
+
+            if os.path.exists(sources_file):
+                with open(sources_file, encoding="utf-8") as f:
+                    if json.load(f) == sources:
+                        return LocalIndex.load(directory)
+            local_index = LocalIndex.build(load_local_documents(self.sessions))
+            local_index.save(directory)
+            # Written last, so that only complete indexes are loaded.
+            with open(sources_file, "w", encoding="utf-8") as f:
+                json.dump(sources, f)
+            return local_index
+
+        return self._resource("local_index", create_local_index)
+
+    def start_completion(
+        self,
+        attempt: int,
+        request: CompletionRequest,
+        prompt: str,
+        stream: bool,
+        events: queue.Queue,
+    ):
+        """
+        Send a completion request in the background, putting `(attempt, event, value)`
+        tuples in the queue: a "started" event once the request has a session,
+        a "chunk" event for every chunk of the answer, or the whole answer if it
+        is not streamed, then an "end" event, or an "error" event with the error.
+        Nothing is put in the queue once the request is cancelled.
+
+        Args:
+            attempt (int): The number of the request, to tell the events apart.
+            request (CompletionRequest): The request, with its model.
+            prompt (str): The prompt to generate a completion for.
+            stream (bool): Stream the answer chunk by chunk.
+            events (queue.Queue): The queue to put the events in.
+        """
+
+        def run():
+            try:
+                with self.sessions.checkout() as session:
+                    if request.cancelled.is_set():
+                        return
+                    events.put((attempt, "started", None))
+                    if stream:
+                        for chunk in Complete(request.model, prompt, session=session, stream=True):
+                            if request.cancelled.is_set():
+                                return
+                            events.put((attempt, "chunk", chunk))
+                    else:
+                        query = session.sql(
+                            "SELECT snowflake.cortex.complete(?,?)", (request.model, prompt)
+                        ).collect_nowait()
+                        request.attach(query)
+                        events.put((attempt, "chunk", query.result()[0][0]))
+                events.put((attempt, "end", None))
+            except Exception as e:
+                if not request.cancelled.is_set():
+                    events.put((attempt, "error", e))
+
+        self._completion_executor.submit(contextvars.copy_context().run, run)
+
+    def race_completion(
+        self, model: str, prompt: str, settings: PipelineSettings, stream: bool
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        Generate a completion resilient to slow and failing calls. When the model
+        is slower than in `HEDGE_PERCENTILE` percent of its recent calls, a duplicate
+        request is sent, and the first of the two to answer wins. Until the model
+        has `HEDGE_MIN_CALLS` recent calls, the duplicate is sent after the fixed
+        delay of the settings instead. When the model has not answered by the
+        deadline of the call, or failed, the next, faster, model of the fallback
+        cascade is asked, while the earlier requests keep running.
+        The deadline is for the whole answer, or for its first chunk if it is
+        streamed. Both the delay of the duplicate and the deadline count from the
+        moment the first request to the model has a session: the model is not
+        given up on while its request waits for a busy session pool. Once the
+        cascade is exhausted, the requests still running are waited on until the
+        longest wait of the settings, so that a fallback only adds a chance to
+        answer and never cuts an earlier model short. Once a request answers,
+        all the other requests are cancelled.
+
+        Args:
+            model (str): The name of the model to use for completion.
+            prompt (str): The prompt to generate a completion for.
+            settings (PipelineSettings): The options of the answer pipeline.
+            stream (bool): Stream the answer chunk by chunk.
+
+        Yields:
+            tuple: The model that answered and the next chunk of its answer.
+        """
+        models = fallback_models(model, prompt) if settings.model_fallback else [model]
+        events = queue.Queue()
+        requests = []
+        running = set()
+        started = {}
+
+        def start(candidate: str):
+            requests.append(CompletionRequest(candidate))
+            running.add(len(requests) - 1)
+            self.start_completion(len(requests) - 1, requests[-1], prompt, stream, events)
+
+        def timing_key(candidate: str) -> str:
+            return f"completion {candidate}" + (" first chunk" if stream else "")
+
+        def receive(timeout: Optional[float]):
+            nonlocal winner, event, chunk, error
+            try:
+                attempt, event, chunk = events.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if event == "started":
+                started[attempt] = time.perf_counter()
+            elif event == "chunk":
+                winner = attempt
+            else:
+                running.discard(attempt)
+                error = chunk or error
+
+        started_at = time.perf_counter()
+        give_up_at = started_at + settings.completion_max_wait_seconds
+        winner, event, chunk, error = None, None, None, None
+        try:
+            for candidate in models:
+                if time.perf_counter() >= give_up_at:
+                    break
+                start(candidate)
+                hedge_after_seconds = 0
+                if settings.hedge_slow_calls:
+                    hedge_after_seconds = (
+                        self.stage_timings.estimate(
+                            timing_key(candidate), HEDGE_PERCENTILE, HEDGE_MIN_CALLS
+                        )
+                        or settings.hedge_delay_seconds
+                    )
+                hedge = hedge_after_seconds > 0
+                # Wait until any request answers, or the requests to this model
+                # are past the deadline or failed.
+                while winner is None and any(requests[a].model == candidate for a in running):
+                    now = time.perf_counter()
+                    candidate_started = [
+                        t for a, t in started.items() if requests[a].model == candidate
+                    ]
+                    deadline = give_up_at
+                    if candidate_started:
+                        deadline = min(
+                            deadline, min(candidate_started) + settings.completion_deadline_seconds
+                        )
+                    if now >= deadline:
+                        break
+                    if candidate_started and hedge:
+                        hedge_at = min(candidate_started) + hedge_after_seconds
+                        if now >= hedge_at:
+                            start(candidate)
+                            hedge = False
+                        else:
+                            deadline = min(deadline, hedge_at)
+                    receive(deadline - now)
+                if winner is not None:
+                    break
+
+            # The cascade is exhausted: keep waiting on the requests still running.
+            while winner is None and running and time.perf_counter() < give_up_at:
+                receive(give_up_at - time.perf_counter())
+
+            for attempt in running - {winner}:
+                self._cancel_executor.submit(requests[attempt].cancel)
+            if winner is None:
+                if running:
+                    raise TimeoutError(
+                        f"No answer from {', '.join(models)} within "
+                        f"{settings.completion_max_wait_seconds} seconds."
+                    )
+                raise error
+
+            answered_by = requests[winner].model
+            self.stage_timings.add(timing_key(answered_by), time.perf_counter() - started[winner])
+            annotate_span(answered_by=answered_by, requests=len(requests))
+            if stream:
+                annotate_span(first_token_ms=round(1000 * (time.perf_counter() - started_at), 1))
+            if answered_by != model:
+                stage = (current_span.get() or {}).get("stage", "completion")
+                add_note(f"Fallback model of {stage}", f"{model} -> {answered_by}")
+            while event == "chunk":
+                yield answered_by, chunk
+                attempt, event, chunk = events.get()
+                while attempt != winner:
+                    attempt, event, chunk = events.get()
+                if event == "error":
+                    raise chunk
+        finally:
+            # Stop the answer if it is no longer read.
+            if event == "chunk":
+                self._cancel_executor.submit(requests[winner].cancel)
+
+    def complete(self, model: str, prompt: str, settings: PipelineSettings) -> str:
+        """
+        Generate a completion for the given prompt using the specified model,
+        or a fallback model if it is too slow. Return the cached completion
+        instead if the same prompt was already sent to the same model, or
+        wait for the completion if it is being generated for another chat.
+
+        Args:
+            model (str): The name of the model to use for completion.
+            prompt (str): The prompt to generate a completion for.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            str: The generated completion.
+        """
+        annotate_span(model=model, prompt_chars=len(prompt), prompt_tokens=estimate_tokens(prompt))
+        completion_cache = self.completion_cache() if settings.use_completion_cache else None
+        response = None
+        if completion_cache is not None:
+            response = completion_cache.get(
+                model, prompt, settings.completion_cache_ttl_minutes * 60
+            )
+        annotate_span(cache_hit=response is not None)
+
+        if response is None:
+            chunks, coalesced = self.single_flight.do(
+                ("complete", model, prompt, settings.model_fallback),
+                lambda: list(self.race_completion(model, prompt, settings, stream=False)),
+            )
+            annotate_span(coalesced=coalesced, answered_by=chunks[0][0])
+            response = "".join(chunk for _, chunk in chunks)
+            # Answers of fallback models are not cached under the selected model.
+            if completion_cache is not None and not coalesced and chunks[0][0] == model:
+                completion_cache.put(model, prompt, response)
+
+        annotate_span(response_chars=len(response), response_tokens=estimate_tokens(response))
+        return response
+
+    def complete_stream(self, model: str, prompt: str, settings: PipelineSettings) -> Iterator[str]:
+        """
+        Generate a completion for the given prompt using the specified model,
+        or a fallback model if it is too slow, yielding the answer chunk by
+        chunk as soon as the model produces it. Follow the completion instead
+        if it is being streamed for another chat.
+
+        Args:
+            model (str): The name of the model to use for completion.
+            prompt (str): The prompt to generate a completion for.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Yields:
+            str: The next chunk of the generated completion.
+        """
+        annotate_span(model=model, prompt_chars=len(prompt), prompt_tokens=estimate_tokens(prompt))
+        completion_cache = self.completion_cache() if settings.use_completion_cache else None
+        response = None
+        if completion_cache is not None:
+            response = completion_cache.get(
+                model, prompt, settings.completion_cache_ttl_minutes * 60
+            )
+        annotate_span(cache_hit=response is not None)
+
+        if response is not None:
+            yield response
+        else:
+            stream, coalesced = self.single_flight.stream(
+                ("complete_stream", model, prompt, settings.model_fallback),
+                lambda: self.race_completion(model, prompt, settings, stream=True),
+            )
+            annotate_span(coalesced=coalesced)
+            chunks = []
+            answered_by = model
+            for answered_by, chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+            annotate_span(answered_by=answered_by)
+            response = "".join(chunks)
+            # Answers of fallback models are not cached under the selected model.
+            if completion_cache is not None and not coalesced and answered_by == model:
+                completion_cache.put(model, prompt, response)
+
+        annotate_span(response_chars=len(response), response_tokens=estimate_tokens(response))
+
+    def search_local_index(self, query: str, settings: PipelineSettings) -> List[str]:
+        """
+        Retrieve the context documents most relevant to the query
+        from the local index.
+
+        Args:
+            query (str): The query to search the local index with.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            list: The context documents ordered by relevance.
+        """
+        with trace_stage("search", service="local index"):
+            results = self.local_index().search(query, settings.num_retrieved_chunks)
+            annotate_span(results=len(results))
+        return [chunk for chunk, _ in results]
+
+    def fetch_search_results(
+        self, query: str, service_name: str, settings: PipelineSettings
+    ) -> Optional[List[dict]]:
+        """
+        Retrieve the search results most relevant to the query from the given
+        cortex search service, or from the cache of search results.
+        The search column of every result is also stored under the "text" key.
+
+        Args:
+            query (str): The query to search the cortex search service with.
+            service_name (str): The name of the cortex search service.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            list: The search results ordered by relevance, with their attribute
+                columns, or None if the service cannot be queried.
+        """
+        service = self.service_registry()[service_name]
+
+        search_cache = self.search_cache(service_name, service["target_lag_seconds"])
+        search_cache_key = (service_name, query, settings.num_retrieved_chunks)
+        with trace_stage("search", service=service_name):
+            results = search_cache.get(search_cache_key)
+            annotate_span(cache_hit=results is not None)
+            if results is None:
+                try:
+                    with self.sessions.checkout() as session:
+                        context_documents = self.search_service(session, service_name).search(
+                            query,
+                            columns=[service["search_column"], *service["attribute_columns"]],
+                            limit=settings.num_retrieved_chunks,
+                        )
+                except APIError:
+                    annotate_span(fallback="local index")
+                    return None
+                results = [
+                    {**r, "text": r[service["search_column"]]} for r in context_documents.results
+                ]
+                search_cache.put(search_cache_key, results)
+            annotate_span(results=len(results))
+
+        add_note(f"Search cache of {service_name}", (search_cache.hits, search_cache.misses))
+        return results
+
+    def search_cortex_search_services(
+        self, query: str, service_names: List[str], settings: PipelineSettings
+    ) -> List[str]:
+        """
+        Retrieve the context documents most relevant to the query from the
+        given cortex search services, searching all of them concurrently
+        and merging their results with reciprocal rank fusion.
+        If enabled, rerank the results locally, boosting the ones about the
+        episode or characters named in the query, and keep only the best ones.
+        Fall back to the local index if no service can be queried,
+        for example while they are being rebuilt.
+
+        Args:
+            query (str): The query to search the cortex search services with.
+            service_names (list): The names of the cortex search services.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            list: The context documents ordered by relevance.
+        """
+        if len(service_names) == 1:
+            result_lists = [self.fetch_search_results(query, service_names[0], settings)]
+        else:
+            result_lists = run_concurrently(
+                *[
+                    lambda name=name: self.fetch_search_results(query, name, settings)
+                    for name in service_names
+                ]
+            )
+        result_lists = [results for results in result_lists if results is not None]
+
+        if not result_lists:
+            return self.search_local_index(query, settings)
+        results = result_lists[0] if len(result_lists) == 1 else fuse_results(result_lists)
+        if not settings.rerank_chunks:
+            return [r["text"] for r in results]
+
+        with trace_stage("rerank", candidates=len(results)):
+            documents = [r["text"] for r in results]
+            matches = match_attributes(query, results)
+            ranking = rerank(
+                query, documents, [ATTRIBUTE_MATCH_BOOST * match for match in matches]
+            )[: settings.num_reranked_chunks]
+            annotate_span(attribute_matches=sum(matches), results=len(ranking))
+        return [documents[i] for i in ranking]
+
+    def retrieve_documents(self, query: str, settings: PipelineSettings) -> List[str]:
+        """
+        Query the selected cortex search service, all the cortex search services,
+        or the local index, with the given query and retrieve context documents.
+        Concurrent retrievals with the same query and search options, like the
+        same question asked in several chats, share a single search.
+
+        Args:
+            query (str): The query to search with.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            list: The context documents ordered by relevance.
+        """
+        key = (
+            "search",
+            query,
+            settings.retrieval_backend,
+            settings.search_all_services or settings.selected_cortex_search_service,
+            settings.num_retrieved_chunks,
+            settings.rerank_chunks and settings.num_reranked_chunks,
+        )
+        documents, coalesced = self.single_flight.do(
+            key, lambda: self.search_documents(query, settings)
+        )
+        if coalesced:
+            annotate_span(search_coalesced=True)
+        return list(documents)
+
+    def search_documents(self, query: str, settings: PipelineSettings) -> List[str]:
+        """
+        Search the backend selected in the settings with the given query.
+        Searching all the cortex search services leaves out the services
+        of chunks of documents, which can only be selected one at a time,
+        unless there are no other services.
+
+        Args:
+            query (str): The query to search with.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            list: The context documents ordered by relevance.
+        """
+        if settings.retrieval_backend == "Local index":
+            return self.search_local_index(query, settings)
+        if settings.search_all_services:
+            service_names = [s["name"] for s in self.service_metadata()]
+            document_service_names = [
+                name for name in service_names if not name.upper().endswith(CHUNK_SERVICE_SUFFIX)
+            ]
+            return self.search_cortex_search_services(
+                query, document_service_names or service_names, settings
+            )
+        return self.search_cortex_search_services(
+            query, [settings.selected_cortex_search_service], settings
+        )
+
+    def pack_documents(self, documents: List[str], settings: PipelineSettings) -> str:
+        """
+        Return the context documents that fit the token budget as a string.
+
+        Args:
+            documents (list): The context documents ordered by relevance.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            str: The concatenated string of context documents.
+        """
+        context_str = pack_context(
+            documents, settings.model_name__service, settings.context_token_budget
+        )
+        add_note("Context documents", context_str)
+        return context_str
+
+    def query_cortex_search_service(self, query: str, settings: PipelineSettings) -> str:
+        """
+        Retrieve the context documents for the given query, and return
+        the ones that fit the token budget as a string.
+
+        Args:
+            query (str): The query to search the cortex search service with.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            str: The concatenated string of context documents.
+        """
+        return self.pack_documents(self.retrieve_documents(query, settings), settings)
+
+    def merge_speculative_documents(
+        self,
+        question: str,
+        question_summary: str,
+        documents: List[str],
+        settings: PipelineSettings,
+    ) -> List[str]:
+        """
+        Complete the documents retrieved speculatively for the raw question,
+        once the summary of the chat history extending it is known. If every
+        content word the summary adds to the question, like the name of the
+        character a pronoun stands for, already occurs in the documents, they
+        are reused as they are. Otherwise the summary is searched, and both
+        lists of documents are merged with reciprocal rank fusion.
+
+        Args:
+            question (str): The user's question.
+            question_summary (str): The question extended with the chat history.
+            documents (list): The documents retrieved for the raw question.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            list: The context documents ordered by relevance.
+        """
+        question_terms = set(tokenize(question))
+        new_terms = set(tokenize(question_summary)) - question_terms - STOP_WORDS
+        missing_terms = new_terms - set(tokenize(" ".join(documents)))
+        reuse = not missing_terms
+        annotate_span(
+            speculative_new_terms=len(new_terms),
+            speculative_missing_terms=len(missing_terms),
+            speculative_reuse=reuse,
+        )
+        if reuse:
+            return documents
+
+        summary_documents = self.retrieve_documents(question_summary, settings)
+        fused = fuse_results(
+            [[{"text": d} for d in summary_documents], [{"text": d} for d in documents]]
+        )
+        return [r["text"] for r in fused][: max(len(documents), len(summary_documents))]
+
+    def make_chat_history_summary(
+        self, chat_history: str, question: str, settings: PipelineSettings
+    ) -> str:
+        """
+        Generate a summary of the chat history combined with the current
+        question to extend the query
+        context. Use the language model to generate this summary.
+
+        Args:
+            chat_history (str): The chat history to include in the summary.
+            question (str): The current user question to extend with the chat history.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            str: The generated summary of the chat history and question.
+        """
+        prompt = create_chat_history_summary_prompt(chat_history, question)
+        with trace_stage("summary"):
+            summary = self.complete(settings.model_name__summary, prompt, settings)
+        add_note("Chat history summary", summary)
+        return summary
+
+    def update_chat_summary(
+        self,
+        chat_summary: ChatSummary,
+        messages: List[dict],
+        first_message_position: int,
+        settings: PipelineSettings,
+    ) -> ChatSummary:
+        """
+        Update the running summary of the chat, so that it covers all the
+        chat messages up to the last of the given ones. Only the messages
+        not covered yet are folded into the summary. The summary is computed
+        again from the chat history window if the size of the window changed.
+
+        Args:
+            chat_summary (ChatSummary): The running summary of the chat.
+            messages (list): The latest chat messages.
+            first_message_position (int): The position of the first of the messages in the chat.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            ChatSummary: The running summary covering all the messages.
+        """
+        message_count = first_message_position + len(messages)
+        if chat_summary.window != settings.num_chat_messages:
+            chat_summary = ChatSummary(
+                message_count=max(0, message_count - settings.num_chat_messages),
+                window=settings.num_chat_messages,
+            )
+
+        new_messages = messages[max(0, chat_summary.message_count - first_message_position) :]
+        if not new_messages:
+            return chat_summary
+        prompt = create_chat_summary_fold_prompt(
+            chat_summary.summary,
+            format_chat_history(new_messages, settings.max_chat_message_chars),
+        )
+        return replace(
+            chat_summary,
+            summary=self.complete(settings.model_name__summary, prompt, settings),
+            message_count=message_count,
+        )
+
+    def resolve_chat_summary(self, job: Job, wait: bool = True) -> Optional[ChatSummary]:
+        """
+        Retrieve the running summary of the chat before the question of the
+        job. Once the previous job of the chat is finished, its summary,
+        which also covers the previous answer, is used.
+
+        Args:
+            job (Job): The job answering the question.
+            wait (bool): Whether to wait for the previous job to finish.
+
+        Returns:
+            ChatSummary: The running summary of the chat, or None if the
+                previous job is not finished and `wait` is False.
+        """
+        previous_job = self.job(job.previous_job_id)
+        if previous_job is not None:
+            if not previous_job.wait(None if wait else 0):
+                return None
+            if previous_job.status == "done":
+                job.chat_summary = previous_job.chat_summary
+        job.previous_job_id = None
+        return job.chat_summary
+
+    def build_specialized_prompt(self, job: Job, chat_history: str) -> str:
+        """
+        Retrieve the context for the question of the job, using a summary
+        of the chat history as the query if there is any history,
+        and create the prompt of the RAG model. The running summary of the
+        chat is used if enabled, unless the previous job of the chat is
+        still updating it: the chat history is summarized directly then,
+        instead of waiting for it. With speculative retrieval, the raw
+        question is searched while the summary is generated. The question
+        alone is searched if the latency budget of the turn skips the summary.
+
+        Args:
+            job (Job): The job answering the question.
+            chat_history (str): The chat history transcript, empty if not used.
+
+        Returns:
+            str: The generated prompt for the language model.
+        """
+        settings = job.settings
+        chat_summary = None
+        if chat_history and settings.incremental_chat_summary:
+            chat_summary = self.resolve_chat_summary(job, wait=False)
+
+        def summarize() -> str:
+            if chat_summary is None:
+                return self.make_chat_history_summary(chat_history, job.question, settings)
+            job.chat_summary = self.update_chat_summary(
+                chat_summary, job.messages[:-1], job.first_message_position, settings
+            )
+            return self.make_chat_history_summary(job.chat_summary.summary, job.question, settings)
+
+        if not chat_history or "summary" in job.skipped_stages:
+            prompt_context = self.query_cortex_search_service(job.question, settings)
+        elif settings.speculative_retrieval:
+            question_summary, documents = run_concurrently(
+                summarize, lambda: self.retrieve_documents(job.question, settings)
+            )
+            documents = self.merge_speculative_documents(
+                job.question, question_summary, documents, settings
+            )
+            prompt_context = self.pack_documents(documents, settings)
+        else:
+            prompt_context = self.query_cortex_search_service(summarize(), settings)
+
+        return create_specialized_prompt(job.question, chat_history, prompt_context)
+
+    def classify_question(
+        self, user_question: str, chat_history: str, settings: PipelineSettings
+    ) -> str:
+        """
+        Decide which answers are needed for the user question, using
+        a small language model: an answer based on the data of the series,
+        a generic answer, or both of them merged.
+
+        Args:
+            user_question (str): The user's question to classify.
+            chat_history (str): The chat history transcript, empty if not used.
+            settings (PipelineSettings): The options of the answer pipeline.
+
+        Returns:
+            str: One of "series", "generic" or "both".
+        """
+        prompt = create_router_prompt(user_question, chat_history)
+        return parse_route(self.complete(settings.model_name__router, prompt, settings))
+
+    def write_answer(self, job: Job, model: str, prompt: str) -> str:
+        """
+        Generate the final answer to the question of the job and write it
+        to the job, chunk by chunk if streaming is enabled.
+
+        Args:
+            job (Job): The job answering the question.
+            model (str): The name of the model to use for completion.
+            prompt (str): The prompt to generate the answer for.
+
+        Returns:
+            str: The generated answer.
+        """
+        if not job.settings.stream_answer:
+            response = self.complete(model, prompt, job.settings)
+            job.write(response)
+            return response
+
+        chunks = []
+        for chunk in self.complete_stream(model, prompt, job.settings):
+            chunks.append(chunk)
+            job.write(chunk)
+        return "".join(chunks)
+
+    def write_known_answer(self, job: Job, model: str, prompt: str) -> Optional[str]:
+        """
+        Generate an answer to the question of the job and write it to the job,
+        chunk by chunk if streaming is enabled, unless it means "I don't know".
+        Only the first `UNKNOWN_ANSWER_MAX_CHARS` characters are held back
+        to check it, as longer answers are never taken for "I don't know".
+
+        Args:
+            job (Job): The job answering the question.
+            model (str): The name of the model to use for completion.
+            prompt (str): The prompt to generate the answer for.
+
+        Returns:
+            str: The generated answer, or None if it means "I don't know".
+        """
+        if not job.settings.stream_answer:
+            response = self.complete(model, prompt, job.settings)
+            if is_unknown_answer(response):
+                return None
+            job.write(response)
+            return response
+
+        chunks = []
+        held_chars = 0
+        for chunk in self.complete_stream(model, prompt, job.settings):
+            chunks.append(chunk)
+            if held_chars > UNKNOWN_ANSWER_MAX_CHARS:
+                job.write(chunk)
+                continue
+            held_chars += len(chunk)
+            if held_chars > UNKNOWN_ANSWER_MAX_CHARS:
+                job.write("".join(chunks))
+
+        response = "".join(chunks)
+        if held_chars <= UNKNOWN_ANSWER_MAX_CHARS:
+            if is_unknown_answer(response):
+                return None
+            job.write(response)
+        return response
+
+    def over_budget(self, job: Job, stage: str) -> bool:
+        """
+        Check if running the stage would take the turn of the job past its
+        latency budget, given the time spent so far and the recent times of the stage.
+
+        Args:
+            job (Job): The job answering the question.
+            stage (str): The name of the pipeline stage.
+
+        Returns:
+            bool: Whether the stage should be skipped.
+        """
+        budget_seconds = job.settings.latency_budget_seconds
+        elapsed_seconds = time.perf_counter() - job.trace.started_at
+        return 0 < budget_seconds < elapsed_seconds + self.stage_timings.estimate(stage)
+
+    def schedule_stages(self, job: Job) -> List[str]:
+        """
+        Choose the optional stages to skip for the job, so that its turn
+        fits the latency budget given the recent times of the stages.
+
+        Args:
+            job (Job): The job answering the question.
+
+        Returns:
+            list: The names of the stages to skip.
+        """
+        settings = job.settings
+        with trace_stage("schedule"):
+            estimates = {
+                stage: self.stage_timings.estimate(stage)
+                for stage in ["router", "summary", "rag", "generic", "aggregation"]
+            }
+            budget_seconds = settings.latency_budget_seconds - (
+                time.perf_counter() - job.trace.started_at
+            )
+            skipped = plan_skipped_stages(budget_seconds, settings.answer_pipeline, estimates)
+            annotate_span(
+                budget_ms=round(1000 * budget_seconds, 1),
+                estimated_ms=", ".join(f"{stage}={1000 * s:.0f}" for stage, s in estimates.items()),
+                skipped=",".join(skipped),
+            )
+        if skipped:
+            add_note("Skipped stages", ", ".join(skipped))
+        return skipped
+
+    def answer_with_merge(self, job: Job, chat_history: str) -> str:
+        """
+        Answer the user question with both the generic model and the RAG model,
+        and merge the two answers with the aggregation model. If the aggregation
+        would take the turn past its latency budget, return the RAG answer instead,
+        or the generic answer if the RAG model does not know.
+
+        Args:
+            job (Job): The job answering the question.
+            chat_history (str): The chat history transcript, empty if not used.
+
+        Returns:
+            str: The merged answer.
+        """
+        settings = job.settings
+
+        def answer_generic():
+            with trace_stage("generic"):
+                return self.complete(
+                    settings.model_name__generic,
+                    create_generic_prompt(job.question, chat_history),
+                    settings,
+                )
+
+        def answer_service():
+            with trace_stage("rag"):
+                return self.complete(
+                    settings.model_name__service,
+                    self.build_specialized_prompt(job, chat_history),
+                    settings,
+                )
+
+        if settings.run_in_parallel:
+            response_generic, response_service = run_concurrently(answer_generic, answer_service)
+        else:
+            response_generic = answer_generic()
+            response_service = answer_service()
+
+        if self.over_budget(job, "aggregation"):
+            job.skipped_stages.append("aggregation")
+            add_note("Skipped stages", ", ".join(job.skipped_stages))
+            response = response_generic if is_unknown_answer(response_service) else response_service
+            job.write(response)
+            return response
+
+        aggregation_prompt = create_aggregation_prompt(
+            job.question, response_generic, response_service, chat_history
+        )
+        with trace_stage("aggregation"):
+            return self.write_answer(job, settings.model_name__aggregation, aggregation_prompt)
+
+    def answer_with_routing(self, job: Job, chat_history: str) -> str:
+        """
+        Answer the user question with as few model calls as possible.
+        Return the RAG answer directly, unless it means "I don't know",
+        in which case return the generic answer instead. With the classifier
+        pipeline, first decide which answers the question needs, and merge
+        both answers only when the question needs both.
+
+        Args:
+            job (Job): The job answering the question.
+            chat_history (str): The chat history transcript, empty if not used.
+
+        Returns:
+            str: The answer.
+        """
+        settings = job.settings
+        route = "series"
+        if settings.answer_pipeline == "Route with classifier":
+            with trace_stage("router"):
+                route = self.classify_question(job.question, chat_history, settings)
+                annotate_span(route=route)
+
+        if route == "both":
+            if "aggregation" not in job.skipped_stages:
+                return self.answer_with_merge(job, chat_history)
+            route = "series"
+
+        if route == "series":
+            with trace_stage("rag"):
+                response_service = self.write_known_answer(
+                    job,
+                    settings.model_name__service,
+                    self.build_specialized_prompt(job, chat_history),
+                )
+            if response_service is not None:
+                return response_service
+
+        with trace_stage("generic"):
+            return self.write_answer(
+                job,
+                settings.model_name__generic,
+                create_generic_prompt(job.question, chat_history),
+            )
+
+    def answer(self, job: Job):
+        """
+        Answer the question of the job with the pipeline selected in its
+        settings, leaving out the optional stages that do not fit the latency
+        budget of the turn, then extend the running summary of the chat with
+        the question and the answer. The lookup of the service metadata is
+        recorded first, as a cache hit unless it expired since the last turn.
+
+        Args:
+            job (Job): The job answering the question.
+        """
+        settings = job.settings
+        with trace_stage("metadata"):
+            services = self._service_metadata.get(SERVICE_DB_SCHEMA)
+            annotate_span(cache_hit=services is not None)
+            if services is None:
+                services = self.service_metadata()
+            annotate_span(services=len(services))
+
+        if settings.use_chat_history:
+            chat_history = format_chat_history(
+                get_chat_history(job.messages, settings.num_chat_messages),
+                settings.max_chat_message_chars,
+            )
+        else:
+            chat_history = ""
+
+        if settings.latency_budget_seconds > 0:
+            job.skipped_stages = self.schedule_stages(job)
+        if settings.answer_pipeline == "Full merge" and "aggregation" not in job.skipped_stages:
+            response = self.answer_with_merge(job, chat_history)
+        else:
+            response = self.answer_with_routing(job, chat_history)
+        job.set_answer(response)
+
+        if settings.use_chat_history and settings.incremental_chat_summary:
+            with trace_stage("summary_fold"):
+                job.chat_summary = self.update_chat_summary(
+                    self.resolve_chat_summary(job),
+                    [*job.messages, {"role": "assistant", "content": response}],
+                    job.first_message_position,
+                    settings,
+                )
+
+
+def parse_option(option: str) -> tuple:
+    key, value = option.split("=", 1)
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ask The Acolyte chat questions.")
+    parser.add_argument("questions", nargs="+", help="Questions of a single chat, in order.")
+    parser.add_argument("--connection", help="Name of the connection in connections.toml.")
+    parser.add_argument(
+        "--sessions", type=int, default=SESSION_POOL_SIZE, help="Size of the session pool."
+    )
+    parser.add_argument(
+        "--service", help="Cortex search service to use, all services if not given."
+    )
+    parser.add_argument(
+        "--completion-cache",
+        choices=COMPLETION_CACHE_BACKENDS,
+        default=COMPLETION_CACHE_BACKENDS[0],
+        help="Backend of the completion cache.",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Override an option of the pipeline, e.g. answer_pipeline='Route on RAG answer'.",
+    )
+    args = parser.parse_args()
+
+    from snowflake.snowpark import Session
+
+    builder = Session.builder
+    if args.connection:
+        builder = builder.config("connection_name", args.connection)
+    engine = Engine(
+        SessionPool(builder.create, args.sessions), completion_cache_backend=args.completion_cache
+    )
+    settings = PipelineSettings.from_mapping(
+        {
+            "selected_cortex_search_service": args.service,
+            "search_all_services": args.service is None,
+            **dict(parse_option(o) for o in args.set),
+        }
+    )
+
+    messages = []
+    job_id = None
+    for question in args.questions:
+        print(f"User: {question}")
+        messages.append({"role": "user", "content": question})
+        job_id = engine.submit(question, messages, settings, previous_job_id=job_id)
+        print("Assistant: ", end="", flush=True)
+        for chunk in engine.job(job_id).stream():
+            print(chunk, end="", flush=True)
+        print()
+        messages.append({"role": "assistant", "content": engine.job(job_id).answer})
+    engine.job(job_id).wait()
+
+
+if __name__ == "__main__":
+    main()
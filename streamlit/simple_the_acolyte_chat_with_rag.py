@@ -1,50 +1,123 @@
-from textwrap import dedent
-from typing import List
+import itertools
+import time
+from typing import Iterator
 
+import altair as alt
 import streamlit as st
-from snowflake.core import Root
+from snowflake.snowpark import Session
 from snowflake.snowpark.context import get_active_session
+from snowflake.snowpark.exceptions import SnowparkSessionException
+
+from acolyte_engine import (
+    ANSWER_PIPELINES,
+    COMPLETION_CACHE_TTL_SECONDS,
+    HISTORY_FILE,
+    HISTORY_STORES,
+    HISTORY_TABLE,
+    MODEL_CONTEXT_WINDOWS,
+    MODELS,
+    RETRIEVAL_BACKENDS,
+    TRACE_SINKS,
+    ChatHistory,
+    ChatSummary,
+    Engine,
+    Job,
+    PipelineSettings,
+    SessionPool,
+    SnowflakeHistoryStore,
+    SQLiteHistoryStore,
+    TurnTrace,
+    current_trace,
+    trace_stage,
+)
+
+JOB_POLL_SECONDS = 0.1
+HISTORY_PAGE_SIZE = 20
+# Backend of the completion cache shared by all sessions of the application,
+# one of `COMPLETION_CACHE_BACKENDS`. Use "In-process + Snowflake table" to
+# also share the completions with the other replicas of the application.
+COMPLETION_CACHE_BACKEND = "In-process"
+
+
+@st.cache_resource(show_spinner=False)
+def create_session_pool() -> SessionPool:
+    """
+    Create the pool of Snowpark sessions shared by all sessions of the
+    application. In Streamlit in Snowflake, the app has a single active
+    session, so every slot of the pool holds it, and the pool only limits
+    and health checks the concurrent calls. When the app runs locally,
+    every slot opens its own session from `connections.toml`.
+
+    Returns:
+        SessionPool: The pool of Snowpark sessions.
+    """
+    try:
+        active_session = get_active_session()
+    except SnowparkSessionException:
+        return SessionPool(Session.builder.create)
+    return SessionPool(lambda: active_session)
 
-MODELS = [
-    "llama3.1-70b",
-    "mistral-large2",
-    "llama3.1-8b",
-    "mixtral-8x7b",
-]
-SERVICE_DB = "ACOLYTE_DB"
-SERVICE_SCHEMA = "SERVICES"
-SERVICE_DB_SCHEMA = f"{SERVICE_DB}.{SERVICE_SCHEMA}"
+
+@st.cache_resource(show_spinner=False)
+def create_engine() -> Engine:
+    """
+    Create the engine answering the questions, shared by all sessions
+    of the application. Its jobs keep running across script reruns.
+    Its completion cache uses the `COMPLETION_CACHE_BACKEND` backend.
+
+    Returns:
+        Engine: The engine of the chat.
+    """
+    return Engine(create_session_pool(), completion_cache_backend=COMPLETION_CACHE_BACKEND)
+
+
+@st.cache_resource(show_spinner=False)
+def create_history_store(backend: str):
+    """
+    Create the store of chat messages spilled out of memory,
+    shared by all sessions of the application.
+
+    Args:
+        backend (str): One of the stores from `HISTORY_STORES`.
+
+    Returns:
+        The store of chat messages.
+    """
+    if backend == "Snowflake table":
+        return SnowflakeHistoryStore(create_session_pool(), HISTORY_TABLE)
+    return SQLiteHistoryStore(HISTORY_FILE)
 
 
 def init_messages():
     """
     Initialize the session state for chat messages.
     If the session state indicates that the conversation
-    should be cleared or if the "messages" key is not
-    in the session state, initialize it as an empty list.
+    should be cleared or if the "chat_history" key is not
+    in the session state, initialize it as an empty chat history,
+    and forget the running summary and the jobs of the chat.
     """
-    if st.session_state.clear_conversation or "messages" not in st.session_state:
-        st.session_state.messages = []
+    if st.session_state.clear_conversation or "chat_history" not in st.session_state:
+        if "chat_history" in st.session_state:
+            st.session_state.chat_history.clear()
+        st.session_state.chat_history = ChatHistory(
+            create_history_store(st.session_state.history_store)
+        )
+        st.session_state.visible_messages = HISTORY_PAGE_SIZE
+        st.session_state.chat_summary = ChatSummary()
+        st.session_state.pending_job_id = None
+        st.session_state.last_job_id = None
 
 
-def init_service_metadata():
-    """
-    Initialize the session state for cortex search service metadata.
-    Query the available cortex search services from the Snowflake session
-    and store their names and search columns in the session state.
+def init_service_metadata(engine: Engine):
     """
-    if "service_metadata" not in st.session_state:
-        service_metadata = []
+    Initialize the session state for cortex search service metadata
+    with the names, search columns, target lags and attribute columns
+    of the available cortex search services.
 
-        for s in session.sql(
-            f"SHOW CORTEX SEARCH SERVICES IN SCHEMA {SERVICE_DB_SCHEMA};"
-        ).collect():
-            svc_name = s["name"]
-            svc_search_col = session.sql(
-                f"DESC CORTEX SEARCH SERVICE {SERVICE_DB_SCHEMA}.{svc_name};"
-            ).collect()[0]["search_column"]
-            service_metadata.append({"name": svc_name, "search_column": svc_search_col})
-        st.session_state.service_metadata = service_metadata
+    Args:
+        engine (Engine): The engine of the chat.
+    """
+    st.session_state.service_metadata = engine.service_metadata()
 
 
 def init_config_options():
@@ -55,10 +128,12 @@ def init_config_options():
     options to select a model, the number of context chunks,
     and the number of chat messages to use in the chat history.
     """
+    st.sidebar.toggle("Search all cortex search services", key="search_all_services", value=False)
     st.sidebar.selectbox(
         "Select cortex search service:",
         [s["name"] for s in st.session_state.service_metadata],
         key="selected_cortex_search_service",
+        disabled=st.session_state.get("search_all_services", False),
     )
 
     st.sidebar.button("Clear conversation", key="clear_conversation")
@@ -66,6 +141,61 @@ def init_config_options():
     st.sidebar.toggle("Use chat history", key="use_chat_history", value=True, disabled=False)
 
     with st.sidebar.expander("Advanced options"):
+        st.toggle("Run generic and RAG in parallel", key="run_in_parallel", value=True)
+        st.toggle("Stream the final answer", key="stream_answer", value=True)
+        st.toggle("Summarize chat incrementally", key="incremental_chat_summary", value=True)
+        st.toggle("Prefetch search on the raw question", key="speculative_retrieval", value=True)
+        st.number_input(
+            "Latency budget of a turn (seconds, 0 for none)",
+            value=0.0,
+            key="latency_budget_seconds",
+            min_value=0.0,
+            max_value=600.0,
+            step=0.5,
+        )
+        st.selectbox("Answer pipeline:", ANSWER_PIPELINES, key="answer_pipeline", index=0)
+        st.selectbox("Retrieval backend:", RETRIEVAL_BACKENDS, key="retrieval_backend", index=0)
+        st.selectbox("Write turn traces to:", TRACE_SINKS, key="trace_sink", index=0)
+        st.selectbox("Spill older chat messages to:", HISTORY_STORES, key="history_store", index=0)
+
+        st.markdown("### Completion cache:")
+        st.toggle("Reuse cached answers", key="use_completion_cache", value=True)
+        st.number_input(
+            "Maximum age of cached answers (minutes)",
+            value=60,
+            key="completion_cache_ttl_minutes",
+            min_value=1,
+            max_value=COMPLETION_CACHE_TTL_SECONDS // 60,
+            disabled=not st.session_state.get("use_completion_cache", True),
+        )
+
+        st.markdown("### Slow model calls:")
+        st.number_input(
+            "Deadline of a model call (seconds)",
+            value=30,
+            key="completion_deadline_seconds",
+            min_value=1,
+            max_value=600,
+        )
+        st.number_input(
+            "Longest wait for an answer of any model (seconds)",
+            value=120,
+            key="completion_max_wait_seconds",
+            min_value=1,
+            max_value=1800,
+        )
+        st.toggle("Send a duplicate of unusually slow calls", key="hedge_slow_calls", value=True)
+        st.number_input(
+            "Delay of the duplicate until recent calls are timed (seconds)",
+            value=10.0,
+            key="hedge_delay_seconds",
+            min_value=0.5,
+            max_value=600.0,
+            step=0.5,
+            disabled=not st.session_state.get("hedge_slow_calls", True),
+        )
+        st.toggle("Fall back to a faster model past the deadline", key="model_fallback", value=True)
+
         st.markdown("### Select model:")
         st.selectbox("Generic model:", MODELS, key="model_name__generic", index=0)
         st.selectbox("Model for RAG:", MODELS, key="model_name__service", index=0, disabled=False)
@@ -77,6 +207,13 @@ def init_config_options():
             disabled=False,
         )
         st.selectbox("Summary of chat:", MODELS, key="model_name__summary", index=1, disabled=False)
+        st.selectbox(
+            "Routing of questions:",
+            MODELS,
+            key="model_name__router",
+            index=2,
+            disabled=st.session_state.get("answer_pipeline") != "Route with classifier",
+        )
 
         st.number_input(
             "Select number of context chunks",
@@ -86,6 +223,23 @@ def init_config_options():
             max_value=200,
             disabled=False,
         )
+        st.toggle("Rerank retrieved chunks", key="rerank_chunks", value=True)
+        st.number_input(
+            "Select number of reranked chunks to use",
+            value=5,
+            key="num_reranked_chunks",
+            min_value=1,
+            max_value=50,
+            disabled=not st.session_state.get("rerank_chunks", True),
+        )
+        st.number_input(
+            "Select token budget of the context",
+            value=4000,
+            key="context_token_budget",
+            min_value=100,
+            max_value=max(MODEL_CONTEXT_WINDOWS.values()),
+            step=500,
+        )
         st.number_input(
             "Select number of messages to use in chat history",
             value=20,
@@ -94,318 +248,236 @@ def init_config_options():
             max_value=50,
             disabled=False,
         )
+        st.number_input(
+            "Select max number of characters per chat history message",
+            value=2000,
+            key="max_chat_message_chars",
+            min_value=100,
+            max_value=20000,
+            step=100,
+        )
 
-    st.sidebar.expander("Session State").write(st.session_state)
+    if st.session_state.debug:
+        st.sidebar.expander("Session State").write(st.session_state)
 
 
-def query_cortex_search_service(query):
+def display_trace(trace: TurnTrace):
     """
-    Query the selected cortex search service with the given
-    query and retrieve context documents.
-    Display the retrieved context documents in the sidebar if debug
-    mode is enabled. Return the
-    context documents as a string.
+    Display the trace of a chat turn in the sidebar as a timing waterfall,
+    followed by the table of all spans.
 
     Args:
-        query (str): The query to search the cortex search service with.
-
-    Returns:
-        str: The concatenated string of context documents.
+        trace (TurnTrace): The trace of the chat turn.
     """
-    cortex_search_service = (
-        root.databases[SERVICE_DB]
-        .schemas[SERVICE_SCHEMA]
-        .cortex_search_services[st.session_state.selected_cortex_search_service]
-    )
-
-    context_documents = cortex_search_service.search(
-        query, columns=[], limit=st.session_state.num_retrieved_chunks
+    spans = trace.to_record()["spans"]
+    chart = (
+        alt.Chart(alt.Data(values=spans))
+        .mark_bar()
+        .encode(
+            x=alt.X("start_ms:Q", title="ms"),
+            x2="end_ms:Q",
+            y=alt.Y("stage:N", sort=None, title=None),
+            color=alt.Color("stage:N", legend=None),
+            tooltip=["stage:N", "duration_ms:Q", "model:N", "prompt_tokens:Q", "cache_hit:N"],
+        )
     )
-    results = context_documents.results
+    with st.sidebar.expander("Turn timing", expanded=True):
+        st.altair_chart(chart, use_container_width=True)
+        st.dataframe(spans)
 
-    service_metadata = st.session_state.service_metadata
-    search_col = [
-        s["search_column"]
-        for s in service_metadata
-        if s["name"] == st.session_state.selected_cortex_search_service
-    ][0]
-
-    context_str = ""
-    for i, r in enumerate(results):
-        context_str += f"Context document {i+1}: {r[search_col]} \n" + "\n"
-
-    if st.session_state.debug:
-        st.sidebar.text_area("Context documents", context_str, height=500)
 
-    return context_str
-
-
-def get_chat_history() -> List[str]:
+def display_notes(job: Job):
     """
-    Retrieve the chat history from the session state limited
-    to the number of messages specified by the user
-    in the sidebar options.
+    Display the debug notes of a job in the sidebar, like the summary
+    of the chat history and the retrieved context documents.
 
-    Returns:
-        list: The list of chat messages from the session state.
+    Args:
+        job (Job): The job answering the question.
     """
-    start_index = max(0, len(st.session_state.messages) - st.session_state.num_chat_messages)
-    return st.session_state.messages[start_index : len(st.session_state.messages) - 1]
+    for name, note in list(job.notes.items()):
+        if isinstance(note, tuple):
+            st.sidebar.caption(f"{name}: {note[0]} hits, {note[1]} misses")
+        else:
+            st.sidebar.text_area(name, note.replace("$", "\\$"), height=250)
 
 
-def complete(model: str, prompt: str) -> str:
+def update_chat_summary(engine: Engine):
     """
-    Generate a completion for the given prompt using the specified model.
+    Keep the running summary of the chat in the session state up to date
+    with the summary computed by the last finished job of the chat.
 
     Args:
-        model (str): The name of the model to use for completion.
-        prompt (str): The prompt to generate a completion for.
-
-    Returns:
-        str: The generated completion.
+        engine (Engine): The engine of the chat.
     """
-    return session.sql("SELECT snowflake.cortex.complete(?,?)", (model, prompt)).collect()[0][0]
+    job = engine.job(st.session_state.last_job_id)
+    if job is not None and job.status == "done":
+        st.session_state.chat_summary = job.chat_summary
 
 
-def make_chat_history_summary(chat_history: str, question: str) -> str:
+def timed_chunks(chunks: Iterator[str], span: dict) -> Iterator[str]:
     """
-    Generate a summary of the chat history combined with the current
-    question to extend the query
-    context. Use the language model to generate this summary.
+    Yield the given chunks, adding up the time spent waiting for them
+    in the "chunk_wait_ms" attribute of the span.
 
     Args:
-        chat_history (str): The chat history to include in the summary.
-        question (str): The current user question to extend with the chat history.
+        chunks (Iterator): The chunks of the answer.
+        span (dict): The span of the render stage.
 
-    Returns:
-        str: The generated summary of the chat history and question.
-    """
-    prompt = dedent(
-        f"""
-        Based on the chat history below and the question, generate
-        a query that extend the question with the chat history provided.
-        The query should be in natural language.
-        Answer with only the query. Do not add any explanation.
-
-        <chat_history>
-        {chat_history}
-        </chat_history>
-        <question>
-        {question}
-        </question>
+    Yields:
+        str: The next chunk of the answer.
     """
-    )
-
-    summary = complete(st.session_state.model_name__summary, prompt)
-
-    if st.session_state.debug:
-        st.sidebar.text_area("Chat history summary", summary.replace("$", "\$"), height=150)
-
-    return summary
-
-
-def create_specialized_prompt(user_question: str) -> str:
+    wait_seconds = 0
+    while True:
+        started_at = time.perf_counter()
+        chunk = next(chunks, None)
+        wait_seconds += time.perf_counter() - started_at
+        span["chunk_wait_ms"] = round(1000 * wait_seconds, 1)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def show_job(job: Job, message_placeholder) -> str:
     """
-    Create a prompt for the language model by combining the user question
-    with context retrieved from the cortex search service
-    and chat history (if enabled). Format the prompt according to
-    the expected input format of the model.
+    Display the answer of the job in the message placeholder as soon as it
+    is generated. Only wait for the job, which runs in the engine, so the
+    calls in flight are not lost if the script is rerun meanwhile.
+    The time from the first chunk of the answer until it is fully displayed
+    is recorded in the trace of the job, as a "render" span, together with
+    the part of it spent waiting for the next chunks to be generated.
+    The job is then marked as rendered, so that its trace is written.
 
     Args:
-        user_question (str): The user's question to generate a prompt for.
+        job (Job): The job answering the question.
+        message_placeholder: The placeholder of the assistant message.
 
     Returns:
-        str: The generated prompt for the language model.
+        str: The answer.
     """
-    if st.session_state.use_chat_history:
-        chat_history = get_chat_history()
-        if chat_history != []:
-            question_summary = make_chat_history_summary(chat_history, user_question)
-            prompt_context = query_cortex_search_service(question_summary)
-        else:
-            prompt_context = query_cortex_search_service(user_question)
-    else:
-        prompt_context = query_cortex_search_service(user_question)
-        chat_history = ""
-
-    prompt = dedent(
-        f"""
-        You are a helpful AI chat assistant with RAG capabilities.
-
-        Use chat history provided between <chat_history>
-        and </chat_history> tags.
-        Question is between <question> and </question> tags.
-        The context is between <context> and </context> tags.
-
-        You will be working with data from wikipedia.
-        The data contains plot of a series 'The Acolyte'.
-
-        Don't saying things like "according to the provided context".
-        If you don't know the answer just say: "I do not know the answer".
-
-
-        <chat_history>
-        {chat_history}
-        </chat_history>
-        <context>
-        {prompt_context}
-        </context>
-        <question>
-        {user_question}
-        </question>
-
-        Answer:
-        """
-    )
-    return prompt
-
-
-def create_generic_prompt(user_question: str):
+    with st.spinner("Thinking..."):
+        while not job.wait_for_answer(JOB_POLL_SECONDS):
+            pass
+
+    token = current_trace.set(job.trace)
+    try:
+        chunks = job.stream()
+        first_chunks = [chunk for chunk in [next(chunks, None)] if chunk is not None]
+        with trace_stage("render") as span:
+            response = message_placeholder.write_stream(
+                itertools.chain(first_chunks, timed_chunks(chunks, span))
+            )
+    except Exception:
+        job.set_rendered()
+        raise
+    finally:
+        current_trace.reset(token)
+    job.set_rendered()
+    return response
+
+
+def show_pending_job(engine: Engine, avatar: str):
     """
-    Create a prompt for the language model using chat history (if enabled).
-    Format the prompt according to the expected input format of the model.
-    Don't use any additional context.
+    Display the answer of the pending job of the chat, if any, and add it
+    to the chat messages once it is complete. If the script is rerun before
+    that, the job stays pending and is displayed again by the next run.
 
     Args:
-        user_question (str): The user's question to generate a prompt for.
-
-    Returns:
-        str: The generated prompt for the language model.
+        engine (Engine): The engine of the chat.
+        avatar (str): The avatar of the assistant messages.
     """
-    if st.session_state.use_chat_history:
-        chat_history = get_chat_history()
-    else:
-        chat_history = ""
-
-    prompt = dedent(
-        f"""
-        You are a helpful AI chat assistant.
-
-        Use chat history provided between <chat_history>
-        and </chat_history> tags.
-        Question is between <question> and </question> tags.
-
-        If you don't know the answer just say: "I do not know the answer".
+    job = engine.job(st.session_state.pending_job_id)
+    if job is None:
+        st.session_state.pending_job_id = None
+        return
+
+    # Display assistant response in chat message container
+    with st.chat_message("assistant", avatar=avatar):
+        message_placeholder = st.empty()
+        try:
+            response = show_job(job, message_placeholder)
+        except Exception:
+            st.session_state.pending_job_id = None
+            raise
+
+    st.session_state.chat_history.append({"role": "assistant", "content": response})
+    st.session_state.pending_job_id = None
+    st.session_state.last_job_id = job.job_id
 
+    if st.session_state.debug:
+        sessions = engine.sessions
+        st.sidebar.caption(
+            f"Session pool: {sessions.in_use} of {sessions.size} in use, "
+            f"{sessions.created} created, {sessions.replaced} replaced"
+        )
+        st.sidebar.caption(f"Calls shared with other chats: {engine.single_flight.collapsed}")
+        display_notes(job)
+        display_trace(job.trace)
 
-        <chat_history>
-        {chat_history}
-        </chat_history>
-        <question>
-        {user_question}
-        </question>
 
-        Answer:
-        """
-    )
-    return prompt
+def show_earlier_messages():
+    st.session_state.visible_messages += HISTORY_PAGE_SIZE
 
 
-def create_aggregation_prompt(user_question: str, answer_a: str, answer_b: str):
+def display_chat_history(icons: dict):
     """
-    Create a prompt for the language model to combine two answers
-    provided as an input. It is also using question that was asked
-    and chat history (if enabled). Format the prompt according to
-    the expected input format of the model.
+    Display the latest page of chat messages, with a button to also
+    display the previous pages, read from the store if needed.
 
     Args:
-        user_question (str): The user's question to generate a prompt for.
-        answer_a (str): First answer to evaluate and merge.
-        answer_b (str): Second answer to evaluate and merge.
-
-    Returns:
-        str: The generated prompt for the language model.
+        icons (dict): The avatars of the messages by role.
     """
-    if st.session_state.use_chat_history:
-        chat_history = get_chat_history()
-    else:
-        chat_history = ""
-
-    prompt = dedent(
-        f"""
-        You are a helpful AI chat assistant.
-        You are evaluating two answers to a question provided
-        between <question> and </question> tags.
-
-        Provided answers can be found
-        between <answer_a> and </answer_a> for the first answer,
-        and <answer_b> and </answer_b> for second answer.
-
-        Use history of the chat so far that is provided
-        between <chat_history> and </chat_history> tags.
-
-        Merge both answers into one, and return it.
-        Ignore the answer that means "I don't know".
-
-        Don't saying things like "according to the provided context".
-
-        <chat_history>
-        {chat_history}
-        </chat_history>
-        <answer_a>
-        {answer_a}
-        </answer_a>
-        <answer_b>
-        {answer_b}
-        </answer_b>
-        <question>
-        {user_question}
-        </question>
-
-        Answer:
-        """
-    )
-    return prompt
+    chat_history = st.session_state.chat_history
+    start = max(0, len(chat_history) - st.session_state.visible_messages)
+    if start > 0:
+        st.button(
+            f"Show earlier messages ({start} more)",
+            key="show_earlier_messages",
+            on_click=show_earlier_messages,
+        )
+    for message in chat_history.page(start, len(chat_history)):
+        with st.chat_message(message["role"], avatar=icons[message["role"]]):
+            st.markdown(message["content"])
 
 
 def main():
     st.title(f":speech_balloon: The Acolyte")
 
-    init_service_metadata()
+    engine = create_engine()
+    init_service_metadata(engine)
     init_config_options()
     init_messages()
+    update_chat_summary(engine)
 
     icons = {"assistant": "❄️", "user": "☃"}
 
     # Display chat messages from history on app rerun
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"], avatar=icons[message["role"]]):
-            st.markdown(message["content"])
+    display_chat_history(icons)
 
     disable_chat = (
         "service_metadata" not in st.session_state or len(st.session_state.service_metadata) == 0
     )
-    if question := st.chat_input("Ask a question...", disabled=disable_chat):
+    question = st.chat_input("Ask a question...", disabled=disable_chat)
+    # Finish the answer interrupted by a rerun before taking the next question
+    show_pending_job(engine, icons["assistant"])
+
+    if question:
         # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": question})
+        st.session_state.chat_history.append({"role": "user", "content": question})
         # Display user message in chat message container
         with st.chat_message("user", avatar=icons["user"]):
             st.markdown(question.replace("$", "\$"))
 
-        # Display assistant response in chat message container
-        with st.chat_message("assistant", avatar=icons["assistant"]):
-            message_placeholder = st.empty()
-            question = question.replace("'", "")
-            with st.spinner("Thinking..."):
-
-                response_generic = complete(
-                    st.session_state.model_name__generic, create_generic_prompt(question)
-                )
-                response_service = complete(
-                    st.session_state.model_name__service, create_specialized_prompt(question)
-                )
-
-                response_aggregation = complete(
-                    st.session_state.model_name__aggregation,
-                    create_aggregation_prompt(question, response_generic, response_service),
-                )
-
-                message_placeholder.markdown(response_aggregation)
-
-        st.session_state.messages.append({"role": "assistant", "content": response_aggregation})
+        st.session_state.pending_job_id = engine.submit(
+            question.replace("'", ""),
+            list(st.session_state.chat_history.recent),
+            PipelineSettings.from_mapping(st.session_state),
+            st.session_state.chat_summary,
+            st.session_state.last_job_id,
+            st.session_state.chat_history.spilled,
+            render=True,
+        )
+        show_pending_job(engine, icons["assistant"])
 
 
 if __name__ == "__main__":
-    session = get_active_session()
-    root = Root(session)
     main()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The application modules are run as scripts from the streamlit and data directories.
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "streamlit"))
+sys.path.insert(0, os.path.join(ROOT, "data"))
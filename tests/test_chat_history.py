@@ -0,0 +1,65 @@
+import pytest
+
+from acolyte_engine import ChatHistory, SQLiteHistoryStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteHistoryStore(str(tmp_path / "chat_history.sqlite3"))
+
+
+def message(i: int) -> dict:
+    return {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"}
+
+
+def test_keeps_the_last_messages_in_memory_and_spills_the_others(store):
+    chat_history = ChatHistory(store, ring_size=3)
+    for i in range(5):
+        chat_history.append(message(i))
+
+    assert len(chat_history) == 5
+    assert chat_history.spilled == 2
+    assert list(chat_history.recent) == [message(2), message(3), message(4)]
+    assert store.read(chat_history.chat_id, 0, 5) == [message(0), message(1)]
+
+
+def test_pages_span_the_store_and_the_memory(store):
+    chat_history = ChatHistory(store, ring_size=3)
+    for i in range(6):
+        chat_history.append(message(i))
+
+    assert chat_history.page(0, 6) == [message(i) for i in range(6)]
+    assert chat_history.page(2, 4) == [message(2), message(3)]
+    assert chat_history.page(4, 100) == [message(4), message(5)]
+    assert chat_history.page(-5, 1) == [message(0)]
+
+
+def test_chats_sharing_a_store_are_kept_apart(store):
+    chats = [ChatHistory(store, ring_size=1), ChatHistory(store, ring_size=1)]
+    for i in range(3):
+        for chat_history in chats:
+            chat_history.append(message(i))
+
+    assert [c.page(0, 3) for c in chats] == [[message(i) for i in range(3)]] * 2
+
+
+def test_clear_deletes_the_spilled_messages(store):
+    chat_history = ChatHistory(store, ring_size=1)
+    for i in range(3):
+        chat_history.append(message(i))
+
+    chat_history.clear()
+
+    assert len(chat_history) == 0
+    assert store.read(chat_history.chat_id, 0, 3) == []
+
+
+def test_messages_past_the_retention_are_pruned(tmp_path):
+    path = str(tmp_path / "chat_history.sqlite3")
+    chat_history = ChatHistory(SQLiteHistoryStore(path), ring_size=1)
+    for i in range(3):
+        chat_history.append(message(i))
+
+    store = SQLiteHistoryStore(path, retention_seconds=0)
+
+    assert store.read(chat_history.chat_id, 0, 3) == []
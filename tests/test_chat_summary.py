@@ -0,0 +1,64 @@
+import pytest
+
+from acolyte_engine import ChatSummary, Engine, PipelineSettings, SessionPool
+
+
+@pytest.fixture
+def engine():
+    engine = Engine(SessionPool(lambda: None))
+    engine.prompts = []
+
+    def complete(model, prompt, settings):
+        engine.prompts.append(prompt)
+        return f"summary {len(engine.prompts)}"
+
+    engine.complete = complete
+    return engine
+
+
+def chat(count: int) -> list:
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"}
+        for i in range(count)
+    ]
+
+
+def test_folds_only_the_messages_not_covered_yet(engine):
+    settings = PipelineSettings(num_chat_messages=20)
+    chat_summary = ChatSummary("Sol is a Jedi.", message_count=2, window=20)
+
+    updated = engine.update_chat_summary(chat_summary, chat(4), 0, settings)
+
+    assert updated == ChatSummary("summary 1", message_count=4, window=20)
+    assert "Sol is a Jedi." in engine.prompts[0]
+    assert "message 2" in engine.prompts[0] and "message 3" in engine.prompts[0]
+    assert "message 1" not in engine.prompts[0]
+
+
+def test_counts_messages_from_the_start_of_the_chat(engine):
+    settings = PipelineSettings(num_chat_messages=20)
+    chat_summary = ChatSummary("Sol is a Jedi.", message_count=12, window=20)
+
+    updated = engine.update_chat_summary(chat_summary, chat(14)[10:], 10, settings)
+
+    assert updated.message_count == 14
+    assert "message 12" in engine.prompts[0] and "message 11" not in engine.prompts[0]
+
+
+def test_summary_covering_all_messages_is_kept(engine):
+    settings = PipelineSettings(num_chat_messages=20)
+    chat_summary = ChatSummary("Sol is a Jedi.", message_count=4, window=20)
+
+    assert engine.update_chat_summary(chat_summary, chat(4), 0, settings) is chat_summary
+    assert engine.prompts == []
+
+
+def test_new_window_summarizes_the_window_again(engine):
+    settings = PipelineSettings(num_chat_messages=2)
+    chat_summary = ChatSummary("Sol is a Jedi.", message_count=4, window=20)
+
+    updated = engine.update_chat_summary(chat_summary, chat(6), 0, settings)
+
+    assert updated == ChatSummary("summary 1", message_count=6, window=2)
+    assert "Sol is a Jedi." not in engine.prompts[0]
+    assert "message 4" in engine.prompts[0] and "message 3" not in engine.prompts[0]
@@ -0,0 +1,180 @@
+"""
+Tests of the hedged requests and the fallback cascade of completions, with
+a fake pool of Snowpark sessions. No Snowflake account is needed.
+"""
+
+import threading
+import time
+
+import pytest
+
+from acolyte_engine import (
+    HEDGE_MIN_CALLS,
+    Engine,
+    PipelineSettings,
+    SessionPool,
+)
+
+WAIT_SECONDS = 5
+
+
+def wait_until(condition, timeout: float = WAIT_SECONDS):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting for the condition."
+        time.sleep(0.01)
+
+
+class FakeQuery:
+    """
+    Stand-in for a Snowpark async job running a completion. Its behavior
+    computes the answer, or raises, until the query is cancelled.
+    """
+
+    def __init__(self, behavior):
+        self.behavior = behavior
+        self.cancelled = threading.Event()
+
+    def collect(self):
+        return []
+
+    def collect_nowait(self):
+        return self
+
+    def result(self):
+        return [[self.behavior(self.cancelled)]]
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class FakeSession:
+    """
+    Stand-in for a Snowpark session answering completions with the
+    behaviors of the models, and recording the queries it ran.
+    """
+
+    def __init__(self, behaviors: dict, queries: list):
+        self.behaviors = behaviors
+        self.queries = queries
+
+    def sql(self, query: str, params: tuple = ()):
+        if "cortex.complete" not in query:
+            return FakeQuery(None)
+        model, _ = params
+        fake_query = FakeQuery(self.behaviors[model].pop(0))
+        self.queries.append((model, fake_query))
+        return fake_query
+
+
+def answer(text: str):
+    return lambda cancelled: text
+
+
+def hang(cancelled: threading.Event) -> str:
+    cancelled.wait(WAIT_SECONDS)
+    raise RuntimeError("SQL execution canceled")
+
+
+def fail(cancelled: threading.Event) -> str:
+    raise RuntimeError("Model unavailable")
+
+
+def answer_after(seconds: float, text: str):
+    def behavior(cancelled: threading.Event) -> str:
+        if cancelled.wait(seconds):
+            raise RuntimeError("SQL execution canceled")
+        return text
+
+    return behavior
+
+
+def create_engine(behaviors: dict):
+    queries = []
+    engine = Engine(SessionPool(lambda: FakeSession(behaviors, queries)))
+    return engine, queries
+
+
+def race(engine: Engine, model: str, settings: PipelineSettings):
+    return list(engine.race_completion(model, "Who is Sol?", settings, stream=False))
+
+
+def test_hedged_request_wins_and_cancels_the_slow_request():
+    engine, queries = create_engine({"llama3.1-8b": [hang, answer("fast")]})
+    for _ in range(HEDGE_MIN_CALLS):
+        engine.stage_timings.add("completion llama3.1-8b", 0.05)
+    settings = PipelineSettings(hedge_slow_calls=True, model_fallback=False)
+
+    assert race(engine, "llama3.1-8b", settings) == [("llama3.1-8b", "fast")]
+    assert len(queries) == 2
+    wait_until(queries[0][1].cancelled.is_set)
+
+
+def test_hedged_request_waits_the_fixed_delay_without_recent_calls():
+    engine, queries = create_engine({"llama3.1-8b": [hang, answer("fast")]})
+    settings = PipelineSettings(
+        hedge_slow_calls=True, hedge_delay_seconds=0.1, model_fallback=False
+    )
+
+    assert race(engine, "llama3.1-8b", settings) == [("llama3.1-8b", "fast")]
+    assert len(queries) == 2
+    wait_until(queries[0][1].cancelled.is_set)
+
+
+def test_model_past_the_deadline_falls_back_to_a_faster_model():
+    engine, queries = create_engine({"llama3.1-70b": [hang], "llama3.1-8b": [answer("fallback")]})
+    settings = PipelineSettings(
+        completion_deadline_seconds=1, hedge_slow_calls=False, model_fallback=True
+    )
+
+    assert race(engine, "llama3.1-70b", settings) == [("llama3.1-8b", "fallback")]
+    assert [model for model, _ in queries] == ["llama3.1-70b", "llama3.1-8b"]
+    wait_until(queries[0][1].cancelled.is_set)
+
+
+def test_failing_model_falls_back_without_waiting_for_the_deadline():
+    engine, queries = create_engine({"llama3.1-70b": [fail], "llama3.1-8b": [answer("fallback")]})
+    settings = PipelineSettings(
+        completion_deadline_seconds=60, hedge_slow_calls=False, model_fallback=True
+    )
+
+    started_at = time.monotonic()
+    assert race(engine, "llama3.1-70b", settings) == [("llama3.1-8b", "fallback")]
+    assert time.monotonic() - started_at < WAIT_SECONDS
+
+
+def test_all_models_failing_raises_the_last_error():
+    engine, queries = create_engine({"llama3.1-70b": [fail], "llama3.1-8b": [fail]})
+    settings = PipelineSettings(hedge_slow_calls=False, model_fallback=True)
+
+    with pytest.raises(RuntimeError, match="Model unavailable"):
+        race(engine, "llama3.1-70b", settings)
+    assert [model for model, _ in queries] == ["llama3.1-70b", "llama3.1-8b"]
+
+
+def test_failing_fallback_keeps_waiting_on_the_model_past_the_deadline():
+    engine, queries = create_engine(
+        {"llama3.1-70b": [answer_after(2, "slow")], "llama3.1-8b": [fail]}
+    )
+    settings = PipelineSettings(
+        completion_deadline_seconds=1, hedge_slow_calls=False, model_fallback=True
+    )
+
+    assert race(engine, "llama3.1-70b", settings) == [("llama3.1-70b", "slow")]
+    assert [model for model, _ in queries] == ["llama3.1-70b", "llama3.1-8b"]
+    assert not queries[0][1].cancelled.is_set()
+
+
+def test_all_models_past_the_longest_wait_time_out():
+    engine, queries = create_engine({"llama3.1-70b": [hang], "llama3.1-8b": [hang]})
+    settings = PipelineSettings(
+        completion_deadline_seconds=1,
+        completion_max_wait_seconds=3,
+        hedge_slow_calls=False,
+        model_fallback=True,
+    )
+
+    with pytest.raises(TimeoutError):
+        race(engine, "llama3.1-70b", settings)
+    for _, query in queries:
+        wait_until(query.cancelled.is_set)
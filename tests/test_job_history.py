@@ -0,0 +1,23 @@
+import acolyte_engine
+from acolyte_engine import Engine, PipelineSettings, SessionPool
+
+WAIT_SECONDS = 5
+
+
+def create_engine() -> Engine:
+    engine = Engine(SessionPool(lambda: None), max_workers=1)
+    engine.answer = lambda job: job.set_answer("Sol is a Jedi.")
+    return engine
+
+
+def test_pending_job_is_not_evicted_until_it_is_rendered(monkeypatch):
+    monkeypatch.setattr(acolyte_engine, "JOB_HISTORY_SIZE", 1)
+    engine = create_engine()
+    pending = engine.submit("Who is Sol?", [], PipelineSettings(), render=True)
+    for question in ["Who is Mae?", "Who is Osha?"]:
+        engine.job(engine.submit(question, [], PipelineSettings())).wait(WAIT_SECONDS)
+
+    job = engine.job(pending)
+    assert job is not None and job.answer == "Sol is a Jedi."
+    job.set_rendered()
+    assert engine.job(pending) is None
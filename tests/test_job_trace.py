@@ -0,0 +1,47 @@
+import threading
+
+import acolyte_engine
+from acolyte_engine import Engine, PipelineSettings, SessionPool
+
+WAIT_SECONDS = 5
+
+
+def create_engine() -> Engine:
+    engine = Engine(SessionPool(lambda: None), max_workers=1)
+    engine.answer = lambda job: job.set_answer("Sol is a Jedi.")
+    engine.traced = threading.Semaphore(0)
+    engine.record_trace = lambda job: engine.traced.release()
+    return engine
+
+
+def test_trace_is_complete_once_the_answer_is_rendered():
+    engine = create_engine()
+    job = engine.job(engine.submit("Who is Sol?", [], PipelineSettings(), render=True))
+
+    assert job.wait(WAIT_SECONDS)
+    assert not engine.traced.acquire(timeout=0.1)
+    job.set_rendered()
+    assert engine.traced.acquire(timeout=0)
+
+
+def test_trace_without_render_is_complete_once_the_job_is_done():
+    engine = create_engine()
+    job = engine.job(engine.submit("Who is Sol?", [], PipelineSettings()))
+
+    assert job.wait(WAIT_SECONDS)
+    assert engine.traced.acquire(timeout=WAIT_SECONDS)
+
+
+def test_answer_never_rendered_neither_holds_a_worker_nor_its_trace(monkeypatch):
+    monkeypatch.setattr(acolyte_engine, "RENDER_WAIT_SECONDS", 0.5)
+    engine = create_engine()
+    unrendered = engine.job(engine.submit("Who is Sol?", [], PipelineSettings(), render=True))
+    next_job = engine.job(engine.submit("Who is Mae?", [], PipelineSettings()))
+
+    # The only worker of the engine is free for the next job right away.
+    assert next_job.wait(0.4)
+    assert unrendered.status == "done"
+    assert engine.traced.acquire(timeout=WAIT_SECONDS)
+    assert engine.traced.acquire(timeout=WAIT_SECONDS)
+    unrendered.set_rendered()
+    assert not engine.traced.acquire(timeout=0.1)
@@ -0,0 +1,38 @@
+"""
+Tests of the choice of the optional pipeline stages skipped to fit a latency budget.
+"""
+
+from acolyte_engine import plan_skipped_stages
+
+ESTIMATES = {"router": 1, "summary": 2, "rag": 4, "generic": 3, "aggregation": 2}
+
+
+def test_nothing_is_skipped_when_the_turn_fits():
+    assert plan_skipped_stages(6, "Full merge", ESTIMATES) == []
+
+
+def test_the_merge_is_given_up_first():
+    assert plan_skipped_stages(5, "Full merge", ESTIMATES) == ["generic", "aggregation"]
+
+
+def test_the_merge_is_kept_when_skipping_the_summary_is_enough():
+    estimates = {**ESTIMATES, "rag": 6, "summary": 4}
+
+    assert plan_skipped_stages(5, "Full merge", estimates) == ["summary"]
+
+
+def test_everything_is_skipped_when_nothing_fits():
+    assert plan_skipped_stages(1, "Full merge", ESTIMATES) == [
+        "generic",
+        "aggregation",
+        "summary",
+    ]
+
+
+def test_the_router_counts_only_for_the_classifier_pipeline():
+    assert plan_skipped_stages(6, "Route with classifier", ESTIMATES) == [
+        "generic",
+        "aggregation",
+    ]
+    assert plan_skipped_stages(4, "Route on RAG answer", ESTIMATES) == []
+    assert plan_skipped_stages(3, "Route on RAG answer", ESTIMATES) == ["summary"]
@@ -0,0 +1,64 @@
+import numpy as np
+
+import acolyte_engine
+from acolyte_engine import (
+    LOCAL_CHUNK_OVERLAP_WORDS,
+    LOCAL_CHUNK_WORDS,
+    Engine,
+    LocalIndex,
+    SessionPool,
+    chunk_document,
+)
+
+DOCUMENTS = [
+    "Actor and character they played: Lee Jung-jae as Sol\n\n\nSol is a Jedi master.",
+    "Actor and character they played: Amandla Stenberg as Osha\n\n\nOsha left the Jedi order.",
+    "The Acolyte, eposode 3\n\n\nPlot: \nThe witches of Brendok raise the twins.",
+]
+
+
+def test_chunks_repeat_the_header_of_the_document():
+    words = " ".join(f"w{i}" for i in range(2 * LOCAL_CHUNK_WORDS))
+
+    chunks = chunk_document(f"Header\n\n\n{words}")
+
+    step = LOCAL_CHUNK_WORDS - LOCAL_CHUNK_OVERLAP_WORDS
+    assert all(chunk.startswith("Header\n") for chunk in chunks)
+    assert chunks[1].split()[1] == f"w{step}"
+    assert chunks[-1].endswith(f"w{2 * LOCAL_CHUNK_WORDS - 1}")
+
+
+def test_search_ranks_the_chunks_matching_the_query():
+    local_index = LocalIndex.build(DOCUMENTS)
+
+    results = local_index.search("Who are the witches of Brendok?", 5)
+
+    assert results[0][0].startswith("The Acolyte, eposode 3")
+    assert all(score > 0 for _, score in results)
+    assert "as Sol" in local_index.search("Sol", 5)[0][0]
+    assert local_index.search("unknown words", 5) == []
+
+
+def test_saved_index_is_memory_mapped_when_loaded(tmp_path):
+    local_index = LocalIndex.build(DOCUMENTS)
+    local_index.save(str(tmp_path))
+
+    loaded = LocalIndex.load(str(tmp_path))
+
+    assert isinstance(loaded.weights, np.memmap)
+    assert loaded.search("Jedi order", 3) == local_index.search("Jedi order", 3)
+
+
+def test_engine_loads_the_saved_index_without_reading_the_documents(tmp_path, monkeypatch):
+    loads = []
+    monkeypatch.setattr(acolyte_engine, "LOCAL_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        acolyte_engine, "load_local_documents", lambda sessions: loads.append(1) or DOCUMENTS
+    )
+
+    built = Engine(SessionPool(lambda: None)).local_index()
+    loaded = Engine(SessionPool(lambda: None)).local_index()
+
+    assert len(loads) == 1
+    assert isinstance(loaded.weights, np.memmap)
+    assert loaded.search("Sol", 1) == built.search("Sol", 1)
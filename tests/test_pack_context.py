@@ -0,0 +1,48 @@
+from acolyte_engine import (
+    CHARS_PER_TOKEN,
+    MODEL_CONTEXT_WINDOWS,
+    PROMPT_RESERVED_TOKENS,
+    estimate_tokens,
+    pack_context,
+)
+
+
+def test_packs_documents_in_rank_order():
+    context = pack_context(["Sol is a Jedi.", "Osha is his padawan."], "llama3.1-70b", 1000)
+
+    assert context == (
+        "Context document 1: Sol is a Jedi. \n\n" "Context document 2: Osha is his padawan. \n\n"
+    )
+
+
+def test_skips_near_duplicates_of_packed_documents():
+    documents = ["Sol is a Jedi master", "sol is a  JEDI master", "Mae is an assassin"]
+
+    context = pack_context(documents, "llama3.1-70b", 1000)
+
+    assert "Context document 2: Mae is an assassin" in context
+    assert context.count("Sol is a Jedi master") == 1
+
+
+def test_stops_at_the_token_budget():
+    documents = ["word " * 100, "other " * 100, "third"]
+    two_documents = pack_context(documents[:2], "llama3.1-70b", 1000)
+
+    context = pack_context(documents, "llama3.1-70b", estimate_tokens(two_documents))
+
+    assert context == two_documents
+
+
+def test_truncates_the_first_document_if_it_does_not_fit():
+    context = pack_context(["word " * 1000], "llama3.1-70b", 100)
+
+    assert context.startswith("Context document 1: word")
+    assert len(context) == 100 * CHARS_PER_TOKEN
+
+
+def test_budget_is_capped_by_the_context_window_of_the_model():
+    window_tokens = MODEL_CONTEXT_WINDOWS["mixtral-8x7b"] - PROMPT_RESERVED_TOKENS
+
+    context = pack_context(["word " * 100000], "mixtral-8x7b", 10**6)
+
+    assert len(context) == window_tokens * CHARS_PER_TOKEN
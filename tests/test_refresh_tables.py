@@ -0,0 +1,58 @@
+from pathlib import Path
+
+from refresh_tables import SOURCES, plan_changes, read_rows, sentence_windows
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+
+def rows(**hashes) -> dict:
+    return {key: {"ROW_HASH": row_hash} for key, row_hash in hashes.items()}
+
+
+def test_plans_inserts_updates_and_unchanged_rows():
+    changes = plan_changes(rows(a="1", b="2", c="3"), {"a": "1", "b": "old", "d": "4"}, False)
+
+    assert changes == {"insert": ["c"], "update": ["b"], "delete": [], "unchanged": 1}
+
+
+def test_deletes_missing_rows_only_when_asked():
+    changes = plan_changes(rows(a="1"), {"a": "1", "d": "4"}, True)
+
+    assert changes["delete"] == ["d"]
+
+
+def test_rows_without_a_hash_count_as_changed():
+    changes = plan_changes(rows(a="1"), {"a": None}, False)
+
+    assert changes["update"] == ["a"] and changes["unchanged"] == 0
+
+
+def test_later_files_replace_the_rows_of_earlier_files():
+    source = SOURCES["episodes"]
+    halves = read_rows(
+        [
+            DATA_DIR / "episodes" / "season_1-episodes_1-4.tsv",
+            DATA_DIR / "episodes" / "season_1-episodes_5-8.tsv",
+        ],
+        source,
+    )
+    whole = read_rows([DATA_DIR / "episodes" / "season_1-all_episodes.tsv"], source)
+
+    assert sorted(halves) == sorted(whole)
+    changes = plan_changes(halves, {k: r["ROW_HASH"] for k, r in whole.items()}, True)
+    assert changes["unchanged"] == len(whole)
+
+
+def test_sentence_windows_overlap_by_one_sentence():
+    text = "Sol is a Jedi. Osha was his padawan. Mae is her twin! Is Mae an assassin? Yes."
+
+    assert sentence_windows(text) == [
+        "Sol is a Jedi. Osha was his padawan. Mae is her twin!",
+        "Mae is her twin! Is Mae an assassin? Yes.",
+    ]
+
+
+def test_short_text_is_a_single_window():
+    assert sentence_windows(" Sol is a Jedi. Osha was his padawan. ") == [
+        "Sol is a Jedi. Osha was his padawan."
+    ]
@@ -0,0 +1,55 @@
+from acolyte_engine import find_episode_number, match_attributes, rerank
+
+CAST = [
+    {"WHO": 'Amandla Stenberg as Verosha "Osha" and Mae-ho "Mae" Aniseya'},
+    {"WHO": "Lee Jung-jae as Sol A respected Jedi Master"},
+    {"WHO": "Charlie Barnett as Yord Fandar"},
+    {"WHO": "Dafne Keen as Jecki Lon"},
+    {"WHO": "Manny Jacinto as the Stranger"},
+    {"WHO": "A puppet as Jedi Master Yoda"},
+]
+
+
+def test_finds_the_episode_named_in_the_question():
+    assert find_episode_number("What happens in episode 3?") == 3
+    assert find_episode_number("Who dies in the fifth episode?") == 5
+    assert find_episode_number("Who is Sol?") is None
+
+
+def test_matches_the_characters_named_in_the_question():
+    matches = match_attributes("Who killed Jecki and Yord?", CAST)
+
+    assert matches == [False, False, True, True, False, False]
+
+
+def test_matches_character_names_only_not_actor_names():
+    assert not any(match_attributes("Which roles did Lee play?", CAST))
+
+
+def test_title_shared_by_two_characters_matches_both():
+    matches = match_attributes("Who is the Jedi?", CAST)
+
+    assert matches == [False, True, False, False, False, True]
+
+
+def test_matches_the_episode_number():
+    episodes = [{"NO": "1"}, {"NO": " 3 "}, {"WHO": "Dafne Keen as Jecki Lon"}]
+
+    assert match_attributes("What happens in episode 3?", episodes) == [False, True, False]
+
+
+def test_rerank_blends_the_original_rank_with_the_query_terms():
+    documents = ["The twins grew up on Brendok.", "Sol trained Osha.", "Nothing relevant here."]
+
+    assert rerank("Who trained Osha?", documents)[0] == 1
+    assert rerank("", documents) == [0, 1, 2]
+    assert rerank("Osha", []) == []
+
+
+def test_rerank_boosts_without_dropping_documents():
+    documents = ["Sol trained Osha.", "Jecki and Yord died.", "The Stranger killed them."]
+
+    ranking = rerank("Who killed Jecki and Yord?", documents, [0, 0.5, 0])
+
+    assert ranking[0] == 1
+    assert sorted(ranking) == [0, 1, 2]
@@ -0,0 +1,72 @@
+import pytest
+
+from acolyte_engine import Engine, SessionPool
+
+
+class FakeSession:
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+
+    def sql(self, query: str):
+        if self.broken:
+            raise RuntimeError("Session no longer exists")
+        return self
+
+    def collect(self):
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+def fail_with(session):
+    with pytest.raises(RuntimeError):
+        with session:
+            raise RuntimeError("Query failed")
+
+
+def test_failed_session_is_closed_and_replaced():
+    sessions = []
+    pool = SessionPool(lambda: sessions.append(FakeSession()) or sessions[-1], size=1)
+    engine = Engine(pool)
+    with pool.checkout() as session:
+        engine._resource(("root", session), lambda: "root")
+        engine._resource(("search_service", session, "SVC"), lambda: "service")
+    fail_with(pool.checkout())
+    session.broken = True
+
+    with pool.checkout() as replacement:
+        pass
+
+    assert replacement is not session
+    assert session.closed and not replacement.closed
+    assert pool.replaced == 1
+    assert [key for key in engine._resources if session in key] == []
+
+
+def test_healthy_session_is_kept_after_a_failed_call():
+    pool = SessionPool(FakeSession, size=1)
+    fail_with(pool.checkout())
+    with pool.checkout() as session:
+        pass
+
+    fail_with(pool.checkout())
+    with pool.checkout() as same_session:
+        pass
+
+    assert same_session is session and not session.closed
+    assert pool.replaced == 0
+
+
+def test_shared_active_session_is_never_closed():
+    active_session = FakeSession()
+    pool = SessionPool(lambda: active_session, size=1)
+    fail_with(pool.checkout())
+    active_session.broken = True
+
+    with pool.checkout() as session:
+        pass
+
+    assert session is active_session and not session.closed
+    assert pool.replaced == 1
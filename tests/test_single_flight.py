@@ -0,0 +1,88 @@
+"""
+Tests of the coalescing of identical calls of different chats into a single call.
+"""
+
+import threading
+import time
+
+import pytest
+
+from acolyte_engine import SingleFlight
+
+WAIT_SECONDS = 5
+
+
+def wait_until(condition, timeout: float = WAIT_SECONDS):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting for the condition."
+        time.sleep(0.01)
+
+
+def run_in_thread(call, results: list) -> threading.Thread:
+    """
+    Run the call in a new thread, adding its result, or its error, to the list.
+    """
+
+    def run():
+        try:
+            results.append(call())
+        except Exception as error:
+            results.append(error)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_single_flight_shares_the_error_of_the_leader():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def leader_call():
+        calls.append("leader")
+        release.wait(WAIT_SECONDS)
+        raise ValueError("leader failed")
+
+    results = []
+    leader = run_in_thread(lambda: single_flight.do("key", leader_call), results)
+    wait_until(lambda: calls)
+    follower = run_in_thread(
+        lambda: single_flight.do("key", lambda: calls.append("follower")), results
+    )
+    wait_until(lambda: single_flight.collapsed == 1)
+    release.set()
+    leader.join(WAIT_SECONDS)
+    follower.join(WAIT_SECONDS)
+
+    assert calls == ["leader"]
+    assert len(results) == 2 and all(isinstance(r, ValueError) for r in results)
+    assert results[0] is results[1]
+    # The failed call is forgotten, so the next caller runs it again.
+    assert single_flight.do("key", lambda: "again") == ("again", False)
+
+
+def test_single_flight_stream_shares_the_chunks_and_error_of_the_leader():
+    single_flight = SingleFlight()
+    release = threading.Event()
+
+    def leader_call():
+        yield "first"
+        release.wait(WAIT_SECONDS)
+        raise ValueError("leader failed")
+
+    leader_stream, leader_shared = single_flight.stream("key", leader_call)
+    assert next(leader_stream) == "first"
+    follower_stream, follower_shared = single_flight.stream("key", lambda: iter(["not run"]))
+
+    results = []
+    follower = run_in_thread(lambda: [chunk for chunk in follower_stream], results)
+    release.set()
+    with pytest.raises(ValueError):
+        next(leader_stream)
+    follower.join(WAIT_SECONDS)
+
+    assert (leader_shared, follower_shared) == (False, True)
+    assert isinstance(results[0], ValueError)
+    assert single_flight._streams == {}